@@ -6,10 +6,8 @@ The variable parameters are specified in the problem dictionary.
 """
 from SALib.sample import saltelli
 from SALib.analyze import sobol
-from mesa.batchrunner import BatchRunnerMP
-from modelgrid import *
-from IPython.display import clear_output
-from tqdm import tqdm
+import numpy as np
+from sweep import BatchRun, sample_runs
 import matplotlib.pyplot as plt
 from itertools import combinations
 from matplotlib import rcParams
@@ -63,55 +61,47 @@ if __name__ == '__main__':
     replicates = 5
     max_steps = 5000
     distinct_samples = 5
+    # Fraction of each run excluded from the statistics
+    warmup = 0.2
+    # Arguments of the ConvergenceMonitor, e.g. {'rel_width': 0.02} to stop
+    # runs once the average speed and cars per lane have converged
+    convergence = None
     
     param_values = saltelli.sample(problem, distinct_samples)
     
-    model_reporters={'Final_avg_speed': avg_speed,
-                     'Final_Cars_in_lane': cars_in_lane,
-                     'Data Collector': lambda m: m.datacollector,
-                     'Total_Avg_speed': avg_speed,
-                     'Total_Cars_in_lane': cars_in_lane,
-                     'Variance_speed': avg_speed,
-                     'Variance_car': cars_in_lane}
-    
-    batch = BatchRunnerMP(RoadSim,
-                          nr_processes=8,
-                          max_steps=max_steps,
-                          variable_parameters={name:[] for name in problem['names']},
-                          model_reporters=model_reporters)
-    
-    count = 0
-    for i in tqdm(range(replicates)):
-        for vals in tqdm(param_values):
-            vals = list(vals)
-            variable_parameters = {}
-            for name, val in zip(problem['names'], vals):
-                variable_parameters[name] = val
-            batch.run_iteration(variable_parameters, tuple(vals), count)
-            count += 1
-    
-    data_original = batch.get_model_vars_dataframe()
-    data = data_original.copy()
+    # Only keep the statistics after the warm-up of each run
+    fixed_parameters = {'warmup': warmup,
+                        'max_steps': max_steps,
+                        'keep_series': False,
+                        'convergence': convergence}
+
+    # All replicates of all samples are spread over the worker processes,
+    # the manifest is returned in the order of the samples. Finished runs
+    # are kept in the store, so an interrupted analysis can be restarted
+    batch = BatchRun(sample_runs(problem, param_values, fixed_parameters,
+                                 replicates),
+                     max_steps=max_steps, out_dir=None, nr_processes=8,
+                     store='run_store')
+    manifest = batch.run_all()
+
+    columns = {'Final_avg_speed': 'Avg_speed_last',
+               'Final_Cars_in_lane': 'Cars_in_lane_last',
+               'Total_Avg_speed': 'Avg_speed_mean',
+               'Total_Cars_in_lane': 'Cars_in_lane_mean',
+               'Variance_speed': 'Avg_speed_var',
+               'Variance_car': 'Cars_in_lane_var'}
+    data = manifest[problem['names'] + ['Run', 'steps']].copy()
+    for name, stat in columns.items():
+        data[name] = manifest[stat]
     print(data.shape)
     
-    for i in tqdm(range(len(data["Data Collector"]))):
-        if isinstance(data["Data Collector"][i], DataCollector):
-            data_speed = data["Data Collector"][i].get_model_vars_dataframe()['Avg_speed']
-            data_cars = data["Data Collector"][i].get_model_vars_dataframe()['Cars_in_lane']
-            tenproc = int(0.2 * (len(data_speed)))
-            data['Total_Avg_speed'][i] = np.average(data_speed[tenproc:])
-            data['Total_Cars_in_lane'][i] = np.average(data_cars[tenproc:])
-            data['Variance_speed'][i] = np.var(data_speed[tenproc:])
-            data['Variance_car'][i] = np.var(data_cars[tenproc:])
-    
-    
     data.to_csv('Sobol_result.csv', sep=',', index=False)
     
     print(data)
     
-    Si_Speed = sobol.analyze(problem, data['Total_Avg_speed'].as_matrix(), print_to_console=False)
+    Si_Speed = sobol.analyze(problem, data['Total_Avg_speed'].to_numpy(), print_to_console=False)
     print("\n")
-    Si_Cars = sobol.analyze(problem, data['Total_Cars_in_lane'].as_matrix(), print_to_console=False)
+    Si_Cars = sobol.analyze(problem, data['Total_Cars_in_lane'].to_numpy(), print_to_console=False)
     
     
     
@@ -0,0 +1,221 @@
+""" Module for the interactive server with background stepping.
+The mesa server steps the model once for every frame the browser asks
+for. The server in this module steps the model in a background thread at
+its own rate instead, and every frame shows the latest state of the model,
+skipping the steps in between.
+"""
+import threading
+from time import perf_counter, sleep
+import numpy as np
+import tornado.escape
+from mesa.visualization.ModularVisualization import ModularServer,\
+    SocketHandler
+from mesa.visualization.modules import ChartModule
+
+
+class ModelRunner(threading.Thread):
+    """
+    Thread which steps a model for as long as frames are requested. When
+    no frame was requested for idle_timeout seconds, e.g. because the run
+    was stopped in the browser, the runner pauses until the next request.
+
+    Attributes:
+        model (obj): The model to step.
+        lock (obj): Lock which is held during each step, and should be held
+            while reading the model from another thread.
+        max_rate (float): Maximum number of steps per second, None to step
+            as fast as possible.
+        idle_timeout (float): Seconds without requests after which the
+            runner pauses.
+    """
+
+    def __init__(self, model, max_rate=None, idle_timeout=1.0):
+        """
+        Args:
+            model (obj): The model to step.
+            max_rate (float): Maximum number of steps per second, None to
+                step as fast as possible.
+            idle_timeout (float): Seconds without requests after which the
+                runner pauses.
+        """
+        super().__init__(daemon=True)
+        self.model = model
+        self.lock = threading.Lock()
+        self.max_rate = max_rate
+        self.idle_timeout = idle_timeout
+        self._requested = -np.inf
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+
+    def request(self):
+        """
+        Signals that a frame was requested, which keeps the runner going.
+        """
+        self._requested = perf_counter()
+        self._wake.set()
+
+    def stop(self):
+        """
+        Stops the runner and waits for the current step to finish.
+        """
+        self._stopped.set()
+        self._wake.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        interval = 1 / self.max_rate if self.max_rate else 0
+        while not self._stopped.is_set():
+            if not self.model.running or \
+                    perf_counter() - self._requested > self.idle_timeout:
+                self._wake.clear()
+                self._wake.wait()
+                continue
+            start = perf_counter()
+            with self.lock:
+                self.model.step()
+            remaining = interval - (perf_counter() - start)
+            # Always yield, so the server thread can render a frame
+            sleep(max(remaining, 0))
+
+
+class BackgroundSocketHandler(SocketHandler):
+    """
+    Websocket handler which answers a step request with the latest state
+    of the model, instead of stepping the model first. The model is
+    rendered for this connection, see BackgroundServer.render_model.
+    """
+
+    @property
+    def viz_state_message(self):
+        return {"type": "viz_state",
+                "data": self.application.render_model(self)}
+
+    def on_close(self):
+        self.application.forget_client(self)
+
+    def on_message(self, message):
+        msg = tornado.escape.json_decode(message)
+        if msg["type"] == "get_step":
+            self.application.runner.request()
+            if not self.application.model.running:
+                self.write_message({"type": "end"})
+            else:
+                self.write_message(self.viz_state_message)
+        else:
+            super().on_message(message)
+
+
+class BackgroundServer(ModularServer):
+    """
+    ModularServer which steps the model in a ModelRunner thread. The
+    browser samples the model at the frame rate set in the interface, and
+    the frames are rendered while holding the lock of the runner, so each
+    frame shows the state after a complete step. Elements with a forget
+    method keep state per connection, e.g. the PackedLaneCanvas, and are
+    rendered for the connection which asked for the frame.
+
+    Attributes:
+        max_rate (float): Maximum number of steps per second, None to step
+            as fast as possible.
+        idle_timeout (float): Seconds without frame requests after which
+            the model pauses.
+        runner (obj): The ModelRunner of the current model.
+    """
+    handlers = [ModularServer.page_handler,
+                (r"/ws", BackgroundSocketHandler),
+                ModularServer.static_handler,
+                ModularServer.local_handler]
+
+    def __init__(self, model_cls, visualization_elements, name="Mesa Model",
+                 model_params={}, max_rate=None, idle_timeout=1.0):
+        """
+        Args:
+            model_cls, visualization_elements, name, model_params: See the
+                mesa ModularServer.
+            max_rate (float): Maximum number of steps per second, None to
+                step as fast as possible.
+            idle_timeout (float): Seconds without frame requests after
+                which the model pauses.
+        """
+        # pylint: disable=dangerous-default-value
+        self.max_rate = max_rate
+        self.idle_timeout = idle_timeout
+        self.runner = None
+        super().__init__(model_cls, visualization_elements, name,
+                         model_params)
+
+    def reset_model(self):
+        """
+        Stops the runner of the current model, creates a new model with the
+        current parameters and starts its runner.
+        """
+        if self.runner is not None:
+            self.runner.stop()
+        super().reset_model()
+        self.runner = ModelRunner(self.model, self.max_rate,
+                                  self.idle_timeout)
+        self.runner.start()
+
+    def render_model(self, client=None):
+        """
+        Renders every visualization element, while holding the lock of the
+        runner.
+
+        Args:
+            client (obj): The socket handler the frame is rendered for,
+                passed to the elements which keep state per connection.
+
+        Returns:
+            A list with the state of each element.
+        """
+        with self.runner.lock:
+            return [element.render(self.model, client)
+                    if hasattr(element, 'forget')
+                    else element.render(self.model)
+                    for element in self.visualization_elements]
+
+    def forget_client(self, client):
+        """
+        Drops the state the visualization elements keep for a closed
+        connection.
+
+        Args:
+            client (obj): The socket handler of the connection.
+        """
+        for element in self.visualization_elements:
+            if hasattr(element, 'forget'):
+                element.forget(client)
+
+
+class AggregateChartModule(ChartModule):
+    """
+    ChartModule which plots the mean of each series over all steps
+    collected since the previous frame, instead of only the value of the
+    last step. The values are read from the columns of the RoadCollector,
+    so no step data is converted to lists.
+    """
+
+    def __init__(self, series, canvas_height=200, canvas_width=500,
+                 data_collector_name="datacollector"):
+        super().__init__(series, canvas_height, canvas_width,
+                         data_collector_name)
+        self._model_id = None
+        self._rows = 0
+        self._values = [0]*len(self.series)
+
+    def render(self, model):
+        collector = getattr(model, self.data_collector_name)
+        rows = len(collector)
+        if id(model) != self._model_id or rows < self._rows:
+            self._model_id = id(model)
+            self._rows = 0
+            self._values = [0]*len(self.series)
+        if rows > self._rows:
+            # Steps without cars have a nan speed, which json can not hold
+            with np.errstate(all='ignore'):
+                values = [np.nanmean(collector.get_column(s["Label"])
+                                     [self._rows:]) for s in self.series]
+            self._values = [float(np.nan_to_num(value)) for value in values]
+            self._rows = rows
+        return self._values
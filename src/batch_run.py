@@ -2,17 +2,20 @@
 Module for perfoming a batch run.
 The range parameters can be set in the br_params dictionary.
 The fixed parameters are set in the fixed_params dictionary.
+The step data of each run is stored in the out_dir directory, along with
+a manifest.csv file with the parameters and summary of each run.
+Finished runs are kept in the run_store directory, which is shared with
+SA.py, so an interrupted batch run continues where it stopped.
 """
-from mesa.batchrunner import BatchRunnerMP
-from mesa.datacollection import DataCollector
-import pandas as pd
 import numpy as np
-from modelgrid import RoadSim
+from sweep import BatchRun, parameter_grid
 
 """
 Name of the output file, to be loaded in the OFAT jupyter notebook.
 """
 csv_filename = 'batch_run_lanes.csv'
+out_dir = 'batch_run_lanes'
+store = 'run_store'
 
 
 """
@@ -28,23 +31,14 @@ fixed_params = {"length": 5000,
                 "speed": 100,
                 "agression": 0.7,
                 "min_gap": 1.6,
-                "time_step": 0.1,
-                "init_time": 0}
+                "time_step": 0.1}
 
-br = BatchRunnerMP(RoadSim,
-                   nr_processes=8,
-                   variable_parameters=br_params,
-                   fixed_parameters=fixed_params,
-                   iterations=1,
-                   max_steps=6000,
-                   model_reporters={"Data Collector":
-                                    lambda m: m.datacollector})
-
-br.run_all()
-br_df = br.get_model_vars_dataframe()
-br_step_data = pd.DataFrame()
-for i in range(len(br_df["Data Collector"])):
-    if isinstance(br_df["Data Collector"][i], DataCollector):
-        i_run_data = br_df["Data Collector"][i].get_model_vars_dataframe()
-        br_step_data = br_step_data.append(i_run_data, ignore_index=True)
-br_step_data.to_csv(csv_filename)
+if __name__ == '__main__':
+    br = BatchRun(parameter_grid(br_params, fixed_params, iterations=1),
+                  max_steps=6000,
+                  out_dir=out_dir,
+                  nr_processes=8,
+                  store=store)
+    br.run_all()
+    br_step_data = br.load_steps()
+    br_step_data.to_csv(csv_filename)
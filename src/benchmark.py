@@ -0,0 +1,432 @@
+"""
+Module with benchmarks of the model.
+Each micro benchmark prints a small table and returns the timings so the
+results can also be used from a notebook. The step benchmark suite runs
+RoadSim over a grid of road configurations, writes the results as json and
+compares them against a stored baseline:
+
+    python benchmark.py --suite --out bench.json --baseline baseline.json
+"""
+import sys
+import json
+import platform
+import argparse
+import tracemalloc
+from time import perf_counter
+from types import SimpleNamespace
+import numpy as np
+import kernels
+from lane_grid import LaneSpace
+from modelgrid import RoadSim
+from profiler import StepProfiler
+from cargrid import Car
+from sweep import MODEL_DEFAULTS, parameter_grid, code_version
+
+"""
+The road configurations of the step benchmark suite.
+"""
+SUITE_GRID = {'lanes': [2, 5, 10],
+              'length': [1000, 10000, 50000],
+              'spawn': [0.1, 0.5, 0.9],
+              'agression': [0.2, 0.7]}
+QUICK_GRID = {'lanes': [2, 5],
+              'length': [1000, 5000],
+              'spawn': [0.1, 0.9],
+              'agression': [0.5]}
+
+"""
+Extra fraction of the time a car needs to cross the road added to the
+default warm-up, as cars are slower than their free flow speed on a busy
+road.
+"""
+SETTLE_MARGIN = 0.5
+
+
+def scan_neighbors(positions, agent):
+    """
+    Reference implementation of LaneSpace.get_neighbors which scans the
+    complete (lanes, length) positions array of the three surrounding lanes,
+    as the LaneSpace did before it kept a sorted index. Kept to compare the
+    sorted lane index against.
+    """
+    fronts = [agent.model.length*2,
+              agent.model.length*2,
+              agent.model.length*2]
+    backs = [-100, -100, -100]
+
+    for i in range(0, 3):
+        j = agent.pos[1]-1+i
+        if 0 <= j < len(positions):
+            f_ind = positions[j][(agent.pos[0] < positions[j]).nonzero()]
+            b_ind = positions[j][(agent.pos[0] > positions[j]).nonzero()]
+            if len(f_ind):
+                fronts[i] = np.minimum.reduce(f_ind)
+            if len(b_ind):
+                backs[i] = np.maximum.reduce(b_ind)
+    return fronts, backs
+
+
+def _fill_grid(n_cars, lanes, length):
+    """
+    Creates a LaneSpace with n_cars randomly placed agents.
+    """
+    grid = LaneSpace(length, lanes, scale=0.5)
+    model = SimpleNamespace(length=length)
+    agents = []
+    for _ in range(n_cars):
+        agent = SimpleNamespace(model=model, index=None,
+                                pos=(np.random.rand()*length,
+                                     np.random.randint(lanes)))
+        grid.place_agent(agent)
+        agents.append(agent)
+    return grid, agents
+
+
+def bench_neighbors(counts=(100, 500, 1000, 5000, 10000), lanes=6,
+                    length=20000, repeat=3):
+    """
+    Times the neighbour lookups of a single model step, i.e. one query
+    for each car, using both the full lane scan and the sorted index.
+
+    Args:
+        counts (tuple): The numbers of cars on the road to benchmark.
+        lanes (int): Number of lanes of the road.
+        length (int): Length of the road in meters.
+        repeat (int): Number of repetitions, the fastest one is reported.
+
+    Returns:
+        A list of (cars, scan seconds, index seconds) tuples.
+    """
+    results = []
+    print(f"{'cars':>8} {'scan (s)':>10} {'index (s)':>10} {'speedup':>8}")
+    for n_cars in counts:
+        grid, agents = _fill_grid(n_cars, lanes, length)
+        # The old positions array had a column per half meter of road
+        positions = np.full((lanes, length//2), np.nan)
+        positions[:, :grid.length] = grid.positions
+        timings = []
+        for lookup, space in ((scan_neighbors, positions),
+                              (LaneSpace.get_neighbors, grid)):
+            best = np.inf
+            for _ in range(repeat):
+                start = perf_counter()
+                for agent in agents:
+                    lookup(space, agent)
+                best = min(best, perf_counter() - start)
+            timings.append(best)
+        scan, index = timings
+        print(f"{n_cars:>8} {scan:>10.4f} {index:>10.4f} {scan/index:>8.1f}")
+        results.append((n_cars, scan, index))
+    return results
+
+
+def _count_passes(model):
+    """
+    Private function which records the number of get_move passes of every
+    car, by wrapping the move method of the model instance. Every car calls
+    move once after get_move, so the slowdown iterations counted since the
+    previous move are those of the car.
+
+    Returns:
+        A list to which the passes of each car are appended.
+    """
+    passes = []
+    move = model.move
+    last = [model.slowdown_loops]
+
+    def counted_move(agent, new_lane):
+        passes.append(1 + model.slowdown_loops - last[0])
+        last[0] = model.slowdown_loops
+        return move(agent, new_lane)
+    model.move = counted_move
+    return passes
+
+
+def bench_slowdown(steps=2000, warmup=500, seeds=(0, 1, 2, 3, 4), lanes=4,
+                   spawn=0.9, agression=0.3, min_gap=0.5):
+    """
+    Times every step of congested runs with the iterative slowdown loop
+    and with the direct slowdown, and counts the get_move passes of every
+    car in every step. A single run says little about the worst case, so
+    each mode is run with several seeds. Reports the mean, 99th percentile
+    and worst case step time over all seeds, the range of the worst case
+    of the individual seeds, and the mean and largest number of passes of
+    a car.
+
+    Args:
+        steps (int): Number of timed steps of each run.
+        warmup (int): Number of untimed steps to fill up the road.
+        seeds (tuple): Seed of each run of both modes.
+        lanes, spawn, agression, min_gap: Parameters of the RoadSim runs.
+
+    Returns:
+        A dictionary with for each slowdown mode the (seeds, steps) step
+        times in seconds and the passes of each car step.
+    """
+    results = {}
+    print(f"{'slowdown':>8} {'mean (ms)':>10} {'p99 (ms)':>10} "
+          f"{'max (ms)':>10} {'seed max (ms)':>14} {'passes':>7} "
+          f"{'max passes':>10}")
+    for slowdown in ('loop', 'direct'):
+        times = np.empty((len(seeds), steps))
+        passes = []
+        for row, seed in enumerate(seeds):
+            model = RoadSim(lanes=lanes, spawn=spawn, agression=agression,
+                            min_gap=min_gap, slowdown=slowdown, seed=seed)
+            for _ in range(warmup):
+                model.step()
+            seed_passes = _count_passes(model)
+            for i in range(steps):
+                start = perf_counter()
+                model.step()
+                times[row, i] = perf_counter() - start
+            passes.extend(seed_passes)
+        passes = np.array(passes)
+        worst = times.max(axis=1) * 1000
+        print(f"{slowdown:>8} {times.mean()*1000:>10.2f} "
+              f"{np.percentile(times, 99)*1000:>10.2f} "
+              f"{times.max()*1000:>10.2f} "
+              f"{worst.min():>6.2f}-{worst.max():<7.2f} "
+              f"{passes.mean():>7.2f} {passes.max():>10}")
+        results[slowdown] = {'times': times, 'passes': passes}
+    return results
+
+
+def bench_memory(counts=(10000, 100000)):
+    """
+    Measures the memory used per car with tracemalloc, both for Car agents
+    and for the array backed cars of the vector engine. The sizes include
+    the attribute values of the cars, but not the shared model.
+
+    Args:
+        counts (tuple): The numbers of cars to create.
+
+    Returns:
+        A list of (cars, agent bytes per car, vector bytes per car) tuples.
+    """
+    results = []
+    print(f"{'cars':>8} {'agent (B)':>10} {'vector (B)':>10}")
+    for n_cars in counts:
+        model = RoadSim(engine='agent')
+        tracemalloc.start()
+        start = tracemalloc.get_traced_memory()[0]
+        cars = [Car(model.next_id(), model, i % model.lanes, model.speed,
+                    model.agression, model.min_gap) for i in range(n_cars)]
+        agent = (tracemalloc.get_traced_memory()[0] - start) / n_cars
+        del cars
+
+        model = RoadSim(engine='vector')
+        start = tracemalloc.get_traced_memory()[0]
+        model.road.add_cars(np.arange(n_cars) % model.lanes)
+        vector = (tracemalloc.get_traced_memory()[0] - start) / n_cars
+        tracemalloc.stop()
+
+        print(f"{n_cars:>8} {agent:>10.1f} {vector:>10.1f}")
+        results.append((n_cars, agent, vector))
+    return results
+
+
+def fill_steps(params, margin=SETTLE_MARGIN):
+    """
+    Returns the number of steps a car needs to cross the road at the free
+    flow speed, plus a margin, after which the road has filled up.
+
+    Args:
+        params (dict): Keyword arguments for RoadSim.
+        margin (float): Extra fraction of the crossing time.
+    """
+    params = dict(MODEL_DEFAULTS, **params)
+    crossing = params['length'] / (params['speed']/3.6 * params['time_step'])
+    return int(np.ceil(crossing * (1 + margin)))
+
+
+def bench_step(params, steps=300, warmup=None, profile_steps=100,
+               memory_steps=20):
+    """
+    Benchmarks RoadSim.step for a single configuration. Fills the road,
+    measures the peak memory allocated over a short window of steps, then
+    times each step, and finally attaches a StepProfiler to split the time
+    of a number of extra steps over its phases. The memory is only traced
+    after the warm-up and the profiler only attached after the timed steps,
+    as both slow down the steps.
+
+    Args:
+        params (dict): Keyword arguments for RoadSim.
+        steps (int): Number of timed steps.
+        warmup (int): Number of steps to fill the road before timing, by
+            default long enough for the first cars to cross the road, see
+            fill_steps.
+        profile_steps (int): Number of steps with timed phases.
+        memory_steps (int): Number of steps with traced memory.
+
+    Returns:
+        A dictionary with the parameters and the measurements: the warm-up
+        steps, the mean, median and 99th percentile step time in seconds,
+        the car steps per second, the mean number of cars, the peak memory
+        in bytes allocated by the traced steps and the fraction of the step
+        time spent in each phase of the StepProfiler.
+    """
+    if warmup is None:
+        warmup = fill_steps(params)
+    model = RoadSim(**params)
+    for _ in range(warmup):
+        model.step()
+
+    tracemalloc.start()
+    for _ in range(memory_steps):
+        model.step()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times = np.empty(steps)
+    cars = np.empty(steps)
+    for i in range(steps):
+        cars[i] = model.get_car_count()
+        start = perf_counter()
+        model.step()
+        times[i] = perf_counter() - start
+
+    profiler = StepProfiler()
+    profiler.attach(model)
+    model.profiler = profiler
+    for _ in range(profile_steps):
+        model.step()
+
+    result = dict(params)
+    result.update({'warmup': warmup,
+                   'step_mean': times.mean(),
+                   'step_median': np.median(times),
+                   'step_p99': np.percentile(times, 99),
+                   'car_steps_per_s': cars.sum() / times.sum(),
+                   'cars': cars.mean(),
+                   'peak_memory': peak_memory})
+    for phase, fraction in profiler.summary()['fractions'].items():
+        result[phase + '_frac'] = fraction
+    return result
+
+
+def run_suite(grid=None, engine='agent', steps=300, warmup=None,
+              profile_steps=100, seed=0):
+    """
+    Runs bench_step for every combination of the grid, see
+    sweep.parameter_grid, and prints a line for each configuration.
+
+    Args:
+        grid (dict): All values of lanes, length, spawn and agression,
+            defaults to SUITE_GRID.
+        engine (str): The RoadSim engine to benchmark.
+        steps, warmup, profile_steps (int): See bench_step, the warm-up
+            of each configuration is stored with its results.
+        seed (int): Seed of all runs.
+
+    Returns:
+        A dictionary with the environment and a list of the results.
+    """
+    runs = parameter_grid(grid or SUITE_GRID,
+                          {'engine': engine, 'seed': seed})
+    results = []
+    print(f"{'lanes':>5} {'length':>7} {'spawn':>5} {'agr':>4} "
+          f"{'warmup':>6} {'step (ms)':>10} {'car steps/s':>12} {'cars':>7} "
+          f"{'peak (MB)':>9}")
+    for params in runs:
+        result = bench_step(params, steps, warmup, profile_steps)
+        print(f"{params['lanes']:>5} {params['length']:>7} "
+              f"{params['spawn']:>5} {params['agression']:>4} "
+              f"{result['warmup']:>6} {result['step_mean']*1000:>10.3f} "
+              f"{result['car_steps_per_s']:>12.0f} {result['cars']:>7.0f} "
+              f"{result['peak_memory']/2**20:>9.2f}")
+        results.append(result)
+    return {'environment': {'python': platform.python_version(),
+                            'numpy': np.__version__,
+                            'numba': kernels.HAVE_NUMBA,
+                            'machine': platform.machine(),
+                            'code_version': code_version()},
+            'settings': {'engine': engine, 'steps': steps, 'warmup': warmup,
+                         'profile_steps': profile_steps, 'seed': seed},
+            'results': results}
+
+
+def compare(report, baseline, tolerance=0.1):
+    """
+    Compares the step times of a suite report against a baseline report.
+    Configurations are matched on their parameters, a configuration has
+    regressed if its median step time, which is less sensitive to noise
+    than the mean, grew by more than the tolerance.
+
+    Args:
+        report (dict): The report of run_suite.
+        baseline (dict): A stored report of run_suite.
+        tolerance (float): Allowed relative increase of the step time.
+
+    Returns:
+        A list with a dictionary for each matched configuration, with the
+        parameters, both step times, their ratio and the verdict.
+    """
+    names = ('engine', 'lanes', 'length', 'spawn', 'agression')
+    reference = {tuple(result[name] for name in names): result
+                 for result in baseline['results']}
+    comparison = []
+    for result in report['results']:
+        key = tuple(result[name] for name in names)
+        if key not in reference:
+            continue
+        ratio = result['step_median'] / reference[key]['step_median']
+        entry = dict(zip(names, key))
+        entry.update({'step_median': result['step_median'],
+                      'baseline_step_median': reference[key]['step_median'],
+                      'ratio': ratio,
+                      'regressed': ratio > 1 + tolerance})
+        comparison.append(entry)
+    regressed = sum(entry['regressed'] for entry in comparison)
+    print(f"{len(comparison)} configurations compared, {regressed} "
+          f"regressed by more than {tolerance:.0%}")
+    for entry in comparison:
+        if entry['regressed']:
+            print(f"  lanes={entry['lanes']} length={entry['length']} "
+                  f"spawn={entry['spawn']} agression={entry['agression']}: "
+                  f"{entry['ratio']:.2f}x")
+    return comparison
+
+
+def _to_builtin(value):
+    """
+    Private function which converts numpy scalars for the json encoder.
+    """
+    return value.item()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--suite', action='store_true',
+                        help='run the step benchmark suite instead of the '
+                             'micro benchmarks')
+    parser.add_argument('--quick', action='store_true',
+                        help='use the small grid of configurations')
+    parser.add_argument('--engine', default='agent')
+    parser.add_argument('--steps', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=None,
+                        help='warm-up steps, by default scaled to the '
+                             'length of the road')
+    parser.add_argument('--out', help='json file to write the report to')
+    parser.add_argument('--baseline', help='json report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    if not args.suite:
+        bench_neighbors()
+        bench_slowdown()
+        bench_memory()
+        sys.exit()
+
+    report = run_suite(QUICK_GRID if args.quick else SUITE_GRID,
+                       engine=args.engine, steps=args.steps,
+                       warmup=args.warmup)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            report['comparison'] = compare(report, json.load(baseline_file),
+                                           args.tolerance)
+    if args.out:
+        with open(args.out, 'w') as out_file:
+            json.dump(report, out_file, indent=1, default=_to_builtin)
+    if any(entry['regressed'] for entry in report.get('comparison', [])):
+        sys.exit(1)
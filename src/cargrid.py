@@ -1,21 +1,25 @@
 """
 Module which defines the car agents
 """
-from mesa import Agent
 import numpy as np
 
 
-class Car(Agent):
+class Car:
     """
     Class which defines the inidividual car agents.
     Each car has a specific unique_id and an index which is the
-    unique_id modulo the resolution of the LaneSpace.
+    slot of the car in the LaneSpace.
+
+    The car provides the same interface as a mesa Agent, but stores its
+    attributes in slots instead of an instance dictionary, which saves the
+    memory of the dictionary for every car. The vector and kernel engines
+    of the model store cars even more compactly as columns of numpy arrays.
 
     Attributes:
         unique_id (int): An integer value which is uniquely defines each agent
         model (obj): An instance of the model class
-        index (int): The unique_id modulo the resolution of the LaneSpace
-            defined in the model instance.
+        index (int): The slot of the car in the LaneSpace defined in the
+            model instance, assigned when the car is placed.
         pos (tuple): The position of the car agent. The first argument of the
             tuple defines the position along the horizontal continuous axis,
             the second value specifies the current lane of the car.
@@ -39,9 +43,12 @@ class Car(Agent):
     """
     # pylint: disable=too-many-instance-attributes
     # pylint: disable=too-many-arguments
+    __slots__ = ('unique_id', 'model', 'pos', 'start_lane', 'index',
+                 'max_speed', 'speed', 'agression', 'gap', 'switch_delay',
+                 'switched')
 
     def __init__(self, unique_id, model, start_lane,
-                 speed, agression, min_gap):
+                 speed, agression, min_gap, max_speed=None, gap=None):
         """
         Args:
             unique_id (int): The unique id of the current agent, generated by
@@ -53,15 +60,24 @@ class Car(Agent):
             agression (float): Agression of the car, bounded between [0,1].
             min_gap (float): The absolute minimum space the car should
                 maintain, relative to it's own speed.
+            max_speed (float): Maximum speed of the car, drawn from speed
+                and agression if not given.
+            gap (float): Gap of the car, drawn from min_gap and agression
+                if not given.
         """
-        super().__init__(unique_id, model)
+        self.unique_id = unique_id
+        self.model = model
         self.start_lane = start_lane
-        self.index = self.unique_id % model.grid.length
+        self.index = None
         self.pos = (0.0, start_lane)
-        self.max_speed = speed+(abs(np.random.randn())*agression)
+        if max_speed is None:
+            max_speed = speed+(abs(self.model.car_rng.randn())*agression)
+        if gap is None:
+            gap = self.model.car_rng.rand() / agression + min_gap
+        self.max_speed = max_speed
         self.speed = self.max_speed
         self.agression = agression
-        self.gap = np.random.rand() / agression + min_gap
+        self.gap = gap
         self.switch_delay = int(5 / agression / self.model.time_step)
         self.switched = self.switch_delay
 
@@ -149,7 +165,7 @@ class Car(Agent):
             cl, cm, cr = self.compute_pars(FRONT, BACK)  # can_left, can_middle, can_right
 
             if cm:  # Can i go forward at current speed?
-                if cr and np.random.rand() > self.agression:
+                if cr and self.model.car_rng.rand() > self.agression:
                     """
                     Keep right if possible, probability decreases with
                     increasing agression
@@ -158,7 +174,7 @@ class Car(Agent):
                     return -1
 
                 if (self.speed < self.max_speed) and\
-                        (np.random.rand() < self.agression):
+                        (self.model.car_rng.rand() < self.agression):
                     """
                     Speed up if slowed down, probability increases
                     with increasing agression. Also overtake to the
@@ -171,20 +187,20 @@ class Car(Agent):
 
             if cl and cr:  # Can i go left and right?
                 if (self.speed < self.max_speed) and\
-                        (np.random.rand() < self.agression):
+                        (self.model.car_rng.rand() < self.agression):
                     """
                     Overtake on the left if slowed and agression allows.
                     Speed up relative to the agression of the car.
                     """
-                    self.speed += np.random.rand()/self.agression*self.model.time_step
+                    self.speed += self.model.car_rng.rand()/self.agression*self.model.time_step
                     self.switched = self.switch_delay
                     return 1
-                if np.random.rand() > self.agression:
+                if self.model.car_rng.rand() > self.agression:
                     """
                     Hold right if agression is low. Also slow down a bit
                     so not to overtake on the right, scaling with agression.
                     """
-                    self.speed -= np.random.rand()/self.agression*self.model.time_step
+                    self.speed -= self.model.car_rng.rand()/self.agression*self.model.time_step
                     self.switched = self.switch_delay
                     return -1
                 if rf > lf:
@@ -194,7 +210,7 @@ class Car(Agent):
                     return -1
                 return 1
 
-            if cl and (np.random.rand() < self.agression):  # Can i go left?
+            if cl and (self.model.car_rng.rand() < self.agression):  # Can i go left?
                 """
                 Move to the left if agression allows.
                 """
@@ -208,14 +224,51 @@ class Car(Agent):
                 high agression could result in an overtake on the right.
                 """
                 self.switched = self.switch_delay
-                self.speed -= np.random.rand()/self.agression*self.model.time_step
+                self.speed -= self.model.car_rng.rand()/self.agression*self.model.time_step
                 return -1
 
             """
             Slow down if none of the moves are possible and try all
             posibilites again. Recalculating the boolean values each loop.
+            With the direct slowdown the car immediately drops below the
+            speed at which a new move becomes possible, instead of slowing
+            down a small random amount each loop.
             """
-            self.speed -= np.random.rand()*self.model.time_step
+            if self.model.slowdown == 'direct':
+                self.speed = min(self.speed,
+                                 self.slowdown_limit(FRONT, BACK, cl))
+            self.speed -= self.model.car_rng.rand()*self.model.time_step
+            self.model.slowdown_loops += 1
+
+    def slowdown_limit(self, FRONT, BACK, can_left):
+        """
+        Computes the highest speed at which the car can go forward, or
+        switch to a lane it can not switch to yet. Inverts the conditions
+        of compute_pars, which all require the gap to exceed a multiple of
+        the cars' speed.
+
+        Args:
+            FRONT (list): Positions of the cars in front on the right,
+                middle and left.
+            BACK (list): Positions of the cars behind on the right,
+                middle and left.
+            can_left (bool): If the car can already switch to the left,
+                in which case the left lane is not considered.
+
+        Returns:
+            The speed below which a new move is possible.
+        """
+        rf, mf, lf = FRONT  # right_front, middle_front, left_front
+        rb, mb, lb = BACK  # right_back, middle_back, left_back
+        loc, lane = self.pos
+
+        limit = (mf-loc)/self.gap
+        if self.switched == 0:
+            if not can_left and lane < (self.model.lanes - 1):
+                limit = max(limit, min(lf-loc, 2*(loc-lb))/self.gap)
+            if lane > 0:
+                limit = max(limit, min(rf-loc, 2*(loc-rb))/self.gap)
+        return limit
 
     def check_speed(self, gap):
         """
@@ -228,7 +281,7 @@ class Car(Agent):
         """
         diff = self.max_speed - self.speed
         space = (gap-self.speed)/self.speed/self.gap/self.agression
-        speedup = max(np.random.rand(), np.log(diff*space))*self.model.time_step
+        speedup = max(self.model.car_rng.rand(), np.log(diff*space))*self.model.time_step
         self.speed += speedup
 
     def step(self):
@@ -241,4 +294,4 @@ class Car(Agent):
         move = self.get_move()
         self.model.move(self, move)
         if self.speed > self.max_speed:
-            self.speed -= np.random.rand()*self.model.time_step
+            self.speed -= self.model.car_rng.rand()*self.model.time_step
@@ -0,0 +1,348 @@
+""" Module for ensemble runs of the road model.
+Steps many replicates of the vectorized model together, with the cars of
+all replicates stored in one set of columns, so every step of the whole
+ensemble takes a single pass of array operations.
+"""
+import numpy as np
+import pandas as pd
+from modelgrid import RoadSim
+from random_stream import spawn_streams
+from vector_engine import VectorEngine
+
+
+class EnsembleEngine(VectorEngine):
+    """
+    VectorEngine holding the cars of all replicates of an Ensemble. Every
+    car has the number of its replicate in the rep column, and neighbours
+    are only looked up within the same replicate. The decisions of all cars
+    are drawn from the stream of the ensemble, the attributes of new cars
+    from the stream of their replicate.
+
+    Attributes:
+        models (list): The RoadSim instance of each replicate.
+        rep (array): Replicate of each car.
+    """
+    columns = VectorEngine.columns + ('rep',)
+
+    def __init__(self, host, models, kernel=False):
+        """
+        Args:
+            host (obj): The Ensemble, which provides the road geometry and
+                the random stream of the decisions.
+            models (list): The RoadSim instance of each replicate.
+            kernel (bool): Use the compiled kernels to decide the moves.
+        """
+        super().__init__(host, kernel=kernel)
+        self.models = models
+        self.rep = np.empty(0, dtype=int)
+        self._pending = []
+
+    def add_cars(self, lanes, rep=0):
+        """
+        Queues new cars at the start of the road of a replicate, the
+        attributes are drawn as in VectorEngine.add_cars. The cars are
+        added to the columns by flush.
+
+        Args:
+            lanes (array): The start lane of each new car.
+            rep (int): The replicate of the new cars.
+        """
+        model = self.models[rep]
+        lanes = np.asarray(lanes, dtype=int)
+        n = len(lanes)
+        agression = np.full(n, model.agression)
+        max_speed = model.speed + \
+            np.abs(model.car_rng.standard_normal(n))*agression
+        delay = np.full(n, int(5 / model.agression / model.time_step))
+        self._pending.append(
+            {'uid': [model.next_id() for _ in range(n)],
+             'loc': np.zeros(n),
+             'lane': lanes,
+             'speed': max_speed,
+             'max_speed': max_speed,
+             'agression': agression,
+             'gap': model.car_rng.random(n) / agression + model.min_gap,
+             'switch_delay': delay,
+             'switched': delay,
+             'rep': np.full(n, rep)})
+
+    def adopt(self, road, rep):
+        """
+        Queues the cars of the VectorEngine of a replicate.
+        """
+        new = {name: getattr(road, name) for name in VectorEngine.columns}
+        new['rep'] = np.full(road.count, rep)
+        self._pending.append(new)
+
+    def flush(self):
+        """
+        Adds all queued cars to the columns with a single concatenation.
+        """
+        if not self._pending:
+            return
+        for name in self.columns:
+            column = getattr(self, name)
+            setattr(self, name, np.concatenate(
+                [column] + [new[name] for new in self._pending])
+                    .astype(column.dtype))
+        self._pending = []
+
+    def drop(self, reps):
+        """
+        Removes all cars of the given replicates.
+        """
+        self._keep(~np.isin(self.rep, reps))
+
+    def get_free_lanes(self):
+        """
+        Determines for each replicate and lane if the first meters are
+        empty, see RoadSim.get_free_lanes.
+
+        Returns:
+            A (replicates, lanes) boolean array.
+        """
+        lanes = self.model.lanes
+        zone = self.loc < self.model.speed*self.model.time_step
+        occupied = np.bincount(self.rep[zone]*lanes + self.lane[zone],
+                               minlength=len(self.models)*lanes)
+        return occupied.reshape(-1, lanes) == 0
+
+    def get_neighbors(self):
+        """
+        Version of VectorEngine.get_neighbors for all replicates at once.
+        The positions of each replicate are shifted by a multiple of a span
+        larger than the road, so a single sort per lane keeps the replicates
+        apart, and results from another replicate are discarded.
+        """
+        span = 4.0*self.model.length + 1000
+        fronts = np.full((self.count, 3), self.model.length*2.0)
+        backs = np.full((self.count, 3), -100.0)
+        key = self.loc + self.rep*span
+        for j in range(self.model.lanes):
+            in_lane = self.lane == j
+            order = np.argsort(key[in_lane])
+            row = key[in_lane][order]
+            row_rep = self.rep[in_lane][order]
+            if not len(row):
+                continue
+            near = (np.abs(self.lane - j) <= 1).nonzero()[0]
+            x = key[near]
+            rep = self.rep[near]
+            col = j - self.lane[near] + 1
+
+            front = np.searchsorted(row, x, side='right')
+            has = front < len(row)
+            has[has] = row_rep[front[has]] == rep[has]
+            fronts[near[has], col[has]] = row[front[has]] - rep[has]*span
+
+            back = np.searchsorted(row, x, side='left')
+            has = back > 0
+            has[has] = row_rep[back[has]-1] == rep[has]
+            backs[near[has], col[has]] = row[back[has]-1] - rep[has]*span
+        return fronts, backs
+
+
+class ReplicateRoad:
+    """
+    Takes the place of the VectorEngine of a replicate model, and provides
+    the car state of that replicate from the EnsembleEngine. The state is
+    read through the car indices of the replicate, which the Ensemble
+    updates after every step.
+
+    Attributes:
+        engine (obj): The EnsembleEngine holding all cars.
+        rep (int): The replicate of this road.
+        cars (array): Indices of the cars of the replicate in the engine.
+        free_lanes (array): The free lanes of the replicate this step.
+    """
+
+    def __init__(self, engine, rep):
+        """
+        Args:
+            engine (obj): The EnsembleEngine holding all cars.
+            rep (int): The replicate of this road.
+        """
+        self.engine = engine
+        self.rep = rep
+        self.cars = np.empty(0, dtype=int)
+        self.free_lanes = None
+
+    @property
+    def count(self):
+        """ The number of cars on the road. """
+        return len(self.cars)
+
+    @property
+    def uid(self):
+        """ Unique id of each car. """
+        return self.engine.uid[self.cars]
+
+    @property
+    def speed(self):
+        """ Current speed of each car. """
+        return self.engine.speed[self.cars]
+
+    @property
+    def max_speed(self):
+        """ Maximum speed of each car. """
+        return self.engine.max_speed[self.cars]
+
+    @property
+    def lane(self):
+        """ Current lane of each car. """
+        return self.engine.lane[self.cars]
+
+    @property
+    def loc(self):
+        """ Horizontal position of each car. """
+        return self.engine.loc[self.cars]
+
+    def get_free_lanes(self):
+        """
+        Returns the free lanes of the replicate, computed for the whole
+        ensemble at the start of the spawning phase.
+        """
+        return self.free_lanes
+
+    def add_cars(self, lanes):
+        """
+        Queues new cars in the engine, see EnsembleEngine.add_cars.
+        """
+        self.engine.add_cars(lanes, self.rep)
+
+
+class Ensemble:
+    """
+    Runs replicates of the model, with different parameters and seeds, in
+    lock step. Each replicate is a RoadSim with its own spawning, random
+    streams, data collector and convergence monitor, but the cars of all
+    replicates are moved together by one EnsembleEngine. Replicates which
+    have stopped are removed from the engine.
+
+    The replicates have to share the road: the number of lanes, length,
+    speed and time step. As the decisions of the cars are drawn from the
+    stream of the ensemble, a replicate does not reproduce a separate run
+    with the same seed, but follows the same distribution as the vector
+    engine.
+
+    Attributes:
+        runs (list): The RoadSim keyword arguments of each replicate.
+        models (list): The RoadSim instance of each replicate.
+        lanes (int): Number of lanes of all replicates.
+        length (int): Length of the road of all replicates.
+        speed (float): Speed of the cars in m/s of all replicates.
+        time_step (float): Time step of all replicates.
+        car_rng (obj): RandomStream of the decisions of all cars.
+        road (obj): The EnsembleEngine.
+        steps (int): Number of steps taken.
+        slowdown_loops (int): Number of slowdown iterations of the cars of
+            all replicates, see RoadSim.slowdown_loops.
+    """
+    shared = ('lanes', 'length', 'speed', 'time_step')
+
+    def __init__(self, runs, seed=None, kernel=False):
+        """
+        Args:
+            runs (list): The RoadSim keyword arguments of each replicate,
+                see sweep.parameter_grid. The engine is always the vector
+                engine.
+            seed (int): Seed of the decision stream of the ensemble.
+            kernel (bool): Use the compiled kernels to decide the moves.
+        """
+        self.runs = runs
+        self.models = [RoadSim(**dict(params, engine='vector'))
+                       for params in runs]
+        for name in self.shared:
+            if len({getattr(model, name) for model in self.models}) > 1:
+                raise ValueError(f"ensemble replicates must share '{name}'")
+        first = self.models[0]
+        self.lanes = first.lanes
+        self.length = first.length
+        self.speed = first.speed
+        self.time_step = first.time_step
+        self.car_rng = spawn_streams(seed, ('car',))['car']
+        self.steps = 0
+        self.slowdown_loops = 0
+
+        self.road = EnsembleEngine(self, self.models, kernel=kernel)
+        for rep, model in enumerate(self.models):
+            self.road.adopt(model.road, rep)
+            model.road = ReplicateRoad(self.road, rep)
+        self.road.flush()
+        self._assign()
+
+    def _assign(self):
+        """
+        Private method which determines the car indices of every replicate
+        in the engine, with a single stable sort on the replicate column.
+        """
+        order = np.argsort(self.road.rep, kind='stable')
+        bounds = np.cumsum(np.bincount(self.road.rep,
+                                       minlength=len(self.models)))
+        for model, cars in zip(self.models, np.split(order, bounds[:-1])):
+            model.road.cars = cars
+
+    @property
+    def running(self):
+        """ A list with the running state of each replicate. """
+        return [model.running for model in self.models]
+
+    def step(self):
+        """
+        Advances all running replicates by one step, in the same order as
+        RoadSim.step: move all cars, spawn new cars and collect the data of
+        each replicate.
+        """
+        self.road.step()
+        free_lanes = self.road.get_free_lanes()
+        for rep, model in enumerate(self.models):
+            if not model.running:
+                continue
+            model.schedule.steps += 1
+            model.schedule.time += 1
+            model.road.free_lanes = free_lanes[rep]
+            model.init_cars()
+        self.road.flush()
+        self._assign()
+        for model in self.models:
+            if model.running:
+                model.datacollector.collect(model)
+                if model.recorder is not None:
+                    model.recorder.record(model)
+                if model.monitor is not None and \
+                        model.monitor.stop_step is not None:
+                    model.running = False
+
+        stopped = [rep for rep, model in enumerate(self.models)
+                   if not model.running and model.road.count]
+        if stopped:
+            self.road.drop(stopped)
+            self._assign()
+        self.steps += 1
+
+    def run(self, max_steps):
+        """
+        Steps the ensemble until every replicate has stopped or reached
+        max_steps.
+
+        Returns:
+            The RoadCollector of each replicate.
+        """
+        while any(self.running) and self.steps < max_steps:
+            self.step()
+        return [model.datacollector for model in self.models]
+
+    def summaries(self):
+        """
+        Returns a DataFrame like manifest with the parameters, number of
+        steps and summary statistics of each replicate.
+        """
+        entries = []
+        for rep, (params, model) in enumerate(zip(self.runs, self.models)):
+            entry = {'rep': rep}
+            entry.update(params)
+            entry['steps'] = model.schedule.steps
+            entry['Run'] = model.uid
+            entry.update(model.datacollector.summary())
+            entries.append(entry)
+        return pd.DataFrame(entries)
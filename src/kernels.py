@@ -0,0 +1,131 @@
+""" Module with compiled kernels for the car decision loop.
+The kernels operate on the array backed car state of the VectorEngine and
+are compiled with numba if it is installed. Without numba the exact same
+functions run as plain python. All kernels draw from the numpy Generator
+they are given, which numba shares with python.
+"""
+import numpy as np
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        """
+        Stand-in for the numba decorator which returns the function as is.
+        """
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+@njit(cache=True, error_model='numpy')
+def check_speed(speed, max_speed, agression, gap, front_gap, time_step,
+                rng):
+    """
+    Kernel version of Car.check_speed.
+
+    Returns:
+        The new speed of the car.
+    """
+    diff = max_speed - speed
+    space = (front_gap-speed)/speed/gap/agression
+    speedup = np.log(diff*space)
+    draw = rng.random()
+    # A nan speedup is ignored, as the builtin max does in Car.check_speed
+    if not speedup > draw:
+        speedup = draw
+    return speed + speedup*time_step
+
+
+@njit(cache=True, error_model='numpy')
+def get_moves(loc, lane, speed, max_speed, agression, gap, switch_delay,
+              switched, fronts, backs, lanes, time_step, rng):
+    """
+    Kernel version of Car.get_move, evaluated for every car in turn on the
+    neighbours at the start of the step. Updates the speed and switched
+    arrays in place.
+
+    Args:
+        loc, lane, speed, max_speed, agression, gap, switch_delay, switched
+            (array): The car state columns of the VectorEngine.
+        fronts ((n, 3) array): Positions of the cars in front.
+        backs ((n, 3) array): Positions of the cars behind.
+        lanes (int): Number of lanes of the road.
+        time_step (float): Time in seconds advanced each step.
+        rng (obj): The numpy Generator to draw from.
+
+    Returns:
+        Integer array with the move of each car: -1 if right,
+        0 if forward, 1 if left.
+    """
+    moves = np.zeros(len(loc), dtype=np.int64)
+    for i in range(len(loc)):
+        switched[i] = max(0, switched[i] - 1)
+        x = loc[i]
+        rf, mf, lf = fronts[i, 0], fronts[i, 1], fronts[i, 2]
+        rb, lb = backs[i, 0], backs[i, 2]
+        side_lanes = switched[i] == 0
+        may_left = side_lanes and lane[i] < lanes - 1
+        may_right = side_lanes and lane[i] > 0
+
+        while True:
+            space = gap[i]*speed[i]
+            cl = may_left and lf-x > space and x-lb > 0.5*space
+            cm = mf-x > space
+            cr = may_right and rf-x > space and x-rb > 0.5*space
+
+            if cm:
+                if cr and rng.random() > agression[i]:
+                    switched[i] = switch_delay[i]
+                    moves[i] = -1
+                    break
+                if speed[i] < max_speed[i] and\
+                        rng.random() < agression[i]:
+                    speed[i] = check_speed(speed[i], max_speed[i],
+                                           agression[i], gap[i], mf-x,
+                                           time_step, rng)
+                    if cl:
+                        moves[i] = 1
+                break
+
+            if cl and cr:
+                if speed[i] < max_speed[i] and\
+                        rng.random() < agression[i]:
+                    speed[i] += rng.random()/agression[i]*time_step
+                    switched[i] = switch_delay[i]
+                    moves[i] = 1
+                    break
+                if rng.random() > agression[i]:
+                    speed[i] -= rng.random()/agression[i]*time_step
+                    switched[i] = switch_delay[i]
+                    moves[i] = -1
+                    break
+                moves[i] = -1 if rf > lf else 1
+                break
+
+            if cl and rng.random() < agression[i]:
+                switched[i] = switch_delay[i]
+                moves[i] = 1
+                break
+
+            if cr:
+                switched[i] = switch_delay[i]
+                speed[i] -= rng.random()/agression[i]*time_step
+                moves[i] = -1
+                break
+
+            speed[i] -= rng.random()*time_step
+    return moves
+
+
+@njit(cache=True)
+def clamp_speed(speed, max_speed, time_step, rng):
+    """
+    Kernel version of the maximum speed check at the end of Car.step.
+    """
+    for i in range(len(speed)):
+        if speed[i] > max_speed[i]:
+            speed[i] -= rng.random()*time_step
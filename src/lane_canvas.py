@@ -1,3 +1,5 @@
+import base64
+import numpy as np
 from mesa.visualization.ModularVisualization import VisualizationElement
 
 
@@ -24,10 +26,140 @@ class LaneCanvas(VisualizationElement):
             portrayal = self.portrayal_method(obj)
             x, y = obj.pos
             y = model.grid.lanes-1-y
-            x = x / model.grid.length
+            x = x / model.length
             # y = (y+1) / (model.grid.lanes+1)
             y = (y+1) / (model.grid.lanes+1)
             portrayal["x"] = x
             portrayal["y"] = y
             space_state.append(portrayal)
         return space_state
+
+
+class PackedLaneCanvas(LaneCanvas):
+    """
+    Canvas which sends the cars as packed binary frames instead of a
+    portrayal dictionary per car. Each car is sent as its id, position on
+    the canvas, lane and speed bucket, and lanes.js computes the colours
+    and positions. Most frames only contain the changes since the previous
+    frame: the ids of the removed cars, the position change, lane and
+    bucket of the remaining cars in id order, and the new cars, which
+    always have the highest ids. A full keyframe is sent for a new model,
+    when a change does not fit the delta encoding, and every
+    keyframe_interval frames so clients which missed a frame recover.
+    Every client has its own delta state, as each websocket connection
+    asks for frames at its own rate, see BackgroundServer.render_model.
+
+    The frame is base64 encoded, as the mesa server sends json messages.
+    All numbers are little endian, starting with a header of 8 uint32
+    values: version, frame number, type (0 keyframe, 1 delta), removed,
+    kept and added cars, lanes and speed buckets. Then follow the arrays
+    removed ids (uint32), added ids (uint32), added positions (uint16),
+    kept position changes (int16), added lanes, added buckets, kept lanes
+    and kept buckets (uint8). Positions are scaled from 0 to 65535 over
+    the length of the road.
+
+    Attributes:
+        buckets (int): Number of speed buckets.
+        bucket_width (float): Speed range of a bucket in km/h.
+        keyframe_interval (int): Maximum number of frames between
+            keyframes.
+    """
+    version = 1
+
+    def __init__(self, canvas_width=5000, canvas_height=300, buckets=32,
+                 bucket_width=6.25, keyframe_interval=50):
+        """
+        Args:
+            canvas_width (int): Width of the canvas in pixels.
+            canvas_height (int): Height of the canvas in pixels.
+            buckets (int): Number of speed buckets.
+            bucket_width (float): Speed range of a bucket in km/h.
+            keyframe_interval (int): Maximum number of frames between
+                keyframes.
+        """
+        super().__init__(None, canvas_width, canvas_height)
+        self.buckets = buckets
+        self.bucket_width = bucket_width
+        self.keyframe_interval = keyframe_interval
+        self._clients = {}
+
+    def forget(self, client):
+        """
+        Drops the delta state of a client whose connection was closed.
+
+        Args:
+            client (obj): The client, see encode.
+        """
+        self._clients.pop(client, None)
+
+    def encode(self, model, client=None):
+        """
+        Encodes the cars of the model as a binary frame.
+
+        Args:
+            model (obj): The RoadSim instance.
+            client (obj): Hashable identity of the client the frame is sent
+                to, e.g. its websocket handler. The first frame of a client
+                is a keyframe, and later frames are deltas to the previous
+                frame sent to the same client.
+
+        Returns:
+            The frame as bytes.
+        """
+        state = self._clients.setdefault(
+            client, {'frame': 0, 'since_key': 0, 'model_id': None,
+                     'steps': -1, 'uid': None, 'x': None})
+        uid, lane, loc, speed = model.get_cars()
+        order = np.argsort(uid, kind='stable')
+        uid = uid[order].astype(np.uint32)
+        x = np.rint(np.clip(loc[order] / model.length, 0, 1) *
+                    65535).astype(np.int32)
+        lane = lane[order].astype(np.uint8)
+        bucket = np.clip(speed[order]*3.6 / self.bucket_width, 0,
+                         self.buckets-1).astype(np.uint8)
+
+        keyframe = (id(model) != state['model_id'] or
+                    model.schedule.steps < state['steps'] or
+                    state['since_key'] >= self.keyframe_interval)
+        if not keyframe:
+            pos = np.searchsorted(uid, state['uid'])
+            pos[pos == len(uid)] = 0
+            keep = uid[pos] == state['uid'] if len(uid) else \
+                np.zeros(len(state['uid']), dtype=bool)
+            kept = pos[keep]
+            added = np.ones(len(uid), dtype=bool)
+            added[kept] = False
+            dx = x[kept] - state['x'][keep]
+            # New cars have to follow the kept cars in id order
+            if (len(kept) and added[:kept[-1]].any()) or \
+                    (len(dx) and np.abs(dx).max() > 32767):
+                keyframe = True
+
+        if keyframe:
+            removed = np.empty(0, dtype=np.uint32)
+            kept = np.empty(0, dtype=int)
+            dx = np.empty(0, dtype=np.int32)
+            added = np.ones(len(uid), dtype=bool)
+            state['since_key'] = 0
+        else:
+            removed = state['uid'][~keep]
+            state['since_key'] += 1
+
+        header = np.array([self.version, state['frame'], 0 if keyframe else 1,
+                           len(removed), len(kept), np.count_nonzero(added),
+                           model.lanes, self.buckets], dtype='<u4')
+        frame = b''.join([header.tobytes(),
+                          removed.astype('<u4').tobytes(),
+                          uid[added].astype('<u4').tobytes(),
+                          x[added].astype('<u2').tobytes(),
+                          dx.astype('<i2').tobytes(),
+                          lane[added].tobytes(), bucket[added].tobytes(),
+                          lane[kept].tobytes(), bucket[kept].tobytes()])
+        state.update(frame=state['frame'] + 1, model_id=id(model),
+                     steps=model.schedule.steps, uid=uid, x=x)
+        return frame
+
+    def render(self, model, client=None):
+        frame = self.encode(model, client)
+        return {"frame": base64.b64encode(frame).decode('ascii'),
+                "bucket_width": self.bucket_width}
@@ -1,4 +1,5 @@
 """ Module for mixed systems with both a discrete and continuous axis """
+from bisect import bisect_left, bisect_right
 import numpy as np
 np.warnings.filterwarnings('ignore')
 
@@ -11,28 +12,45 @@ class LaneSpace:
     the lanes on a highway. Whilst the other axis is continuous in natue,
     such as the distance traveled on the highway.
 
-    The postion of each agent is stored in a numpy array, indexed to the
-    unique_id of the agent modulo the size of the lane. Although this limits
-    the number of agents it allows for extremely quick operation as no lists
-    or dictionaries have to be maintained. If the number of agents exceeds
-    array capacity the array is dynamically expanded.
+    The postion of each agent is stored in two dense numpy arrays, one with
+    the horizontal position and one with the lane, indexed to a slot which
+    is assigned to the agent when it is placed. The arrays are sized to the
+    number of agents on the road instead of the length of the road. Free
+    slots are kept on a stack, so placing and removing agents never have to
+    search for an empty slot. If the number of agents exceeds the array
+    capacity the arrays are dynamically expanded to twice their size.
+
+    Next to the position arrays each lane keeps an index of its occupied
+    positions, sorted from back to front. Neighbour lookups bisect this
+    index instead of scanning the full lane, which keeps them at
+    O(log n) regardless of the length of the road.
+
+    The number of agents in the first meters of each lane, the spawn zone,
+    is counted as agents are placed, moved and removed, so checking which
+    lanes are free to spawn in does not have to look at any agent.
 
     Attributes:
-        length (int): Scaled length of the array; the number of agents
-            each lane can contain.
+        length (int): Number of slots; the number of agents the space can
+            contain before it is expanded.
         lanes (int): Number of lanes
         time_step (float): Amount of time to advance each step in seconds.
-        positions ((n, l) array): Contains the horizontal position
-            of each agent. These positions are indexed by the current lane and
-            unique id of the agent, where n is simply the lane number and
-            l the unique_id of an agent modulo the length of the space.
-            If multiple agents can occupy a meter the scale argument can be
-            used to increase the capacity of each lane. The position index
-            of each agent should then computed modulo the length of the scaled
-            system.
+        locs ([length] array): Contains the horizontal position of the agent
+            in each slot, nan for free slots.
+        lane_ids ([length] array): Contains the lane of the agent in each
+            slot, -1 for free slots.
+        lane_index ([lanes] list): Per lane a sorted list of the positions
+            of all agents in that lane.
+        lane_slots ([lanes] list): Per lane the slots of the agents, in the
+            same order as lane_index.
+        free_slots (list): Stack of the unoccupied slots.
+        spawn_zone (float): Length of the spawn zone at the start of the
+            lanes in meters.
+        zone_counts ([lanes] list): Number of agents in the spawn zone of
+            each lane.
     """
 
-    def __init__(self, length, lanes, time_step=1.0, scale=1.0):
+    def __init__(self, length, lanes, time_step=1.0, scale=1.0,
+                 spawn_zone=0.0):
         """
         Initialize the highway space.
 
@@ -40,55 +58,73 @@ class LaneSpace:
             length (float): The length of the highway in meters
             lanes (int): The number of lanes
             time_step (float): Amount of time to advance each step in seconds.
-            scale (float): Value to scale the position array by, relative to
-                the system length. Can be used to increase the capacity
-                of decrease memory usage.
+            scale (float): Initial number of slots per meter of highway.
+                A value close to the expected density avoids resizing, the
+                slots grow with the number of agents either way.
+            spawn_zone (float): Length of the spawn zone in meters.
         """
-        self._init_len = length
-        self._scale = scale
-        self.length = int(length*scale)
+        self.length = max(int(length*scale), 1)
         self.lanes = lanes
         self.time_step = time_step
-        self.positions = np.full((self.lanes, self.length), np.nan)
+        self.locs = np.full(self.length, np.nan)
+        self.lane_ids = np.full(self.length, -1)
+        self.lane_index = [[] for _ in range(self.lanes)]
+        self.lane_slots = [[] for _ in range(self.lanes)]
+        self.free_slots = list(range(self.length-1, -1, -1))
+        self.spawn_zone = spawn_zone
+        self.zone_counts = [0]*self.lanes
+
+    @property
+    def positions(self):
+        """
+        The positions of all agents as an (n, l) array, indexed by the
+        lane and slot of each agent, with nan for empty places. Is built on
+        request and only intended for inspection.
+        """
+        positions = np.full((self.lanes, self.length), np.nan)
+        slots = (self.lane_ids >= 0).nonzero()[0]
+        positions[self.lane_ids[slots], slots] = self.locs[slots]
+        return positions
 
     def place_agent(self, agent):
         """
-        Place an agent on the highway space. Determines if the agent index
-        is already occupied and increases the scale of the grid if the
-        number of agents exceeds the capacity.
+        Place an agent on the highway space. Assigns a free slot to the
+        agent, and doubles the capacity of the grid first if all slots are
+        occupied.
 
         Args:
-            agent (obj): an agent instance which should have a speed and
-                index property. Representing the agent speed and unique_id
-                modulo length respectively
+            agent (obj): an agent instance which should have a pos and
+                index property. The index is set to the slot of the agent.
 
         Returns:
-            A boolean value if the placement was succesfull.
+            A boolean value if the placement was succesfull, which
+            is always the case.
         """
         loc, lane = agent.pos
-        if np.isnan(self.positions[lane, agent.index]):
-            self.positions[lane, agent.index] = loc
-            agent.pos = (loc, lane)
-            return True
-        if len(agent.model.cars) > self.length:
-            print('agent index not empty')
-            print('rescaling array')
+        if not self.free_slots:
             self._resize_grid()
-        else:
-            print('index not empty but space available')
-        return False
+        agent.index = self.free_slots.pop()
+        self.locs[agent.index] = loc
+        self.lane_ids[agent.index] = lane
+        self._index_insert(lane, loc, agent.index)
+        if loc < self.spawn_zone:
+            self.zone_counts[lane] += 1
+        return True
 
     def _resize_grid(self):
         """
-        Private method to resize the grid if needed. A new array is created
-        with double the capacity, the current positions array is copied to
-        the first half of this array.
+        Private method to resize the grid if needed. New arrays are created
+        with double the capacity, the current arrays are copied to the
+        first half of these arrays and the new slots are freed.
         """
-        self._scale = self._scale * 2
-        new_len = int(self._init_len*self._scale)
-        new_pos = np.full((self.lanes, new_len), np.nan)
-        new_pos[:, :self.length] = self.positions
-        self.positions = new_pos.copy()
+        new_len = 2*self.length
+        new_locs = np.full(new_len, np.nan)
+        new_locs[:self.length] = self.locs
+        new_lanes = np.full(new_len, -1)
+        new_lanes[:self.length] = self.lane_ids
+        self.locs = new_locs
+        self.lane_ids = new_lanes
+        self.free_slots.extend(range(new_len-1, self.length-1, -1))
         self.length = new_len
 
     def move_agent(self, agent, lane_switch):
@@ -112,8 +148,16 @@ class LaneSpace:
         new_loc = loc + (agent.speed * self.time_step)
         new_lane = lane + lane_switch
         if lane_switch:
-            self.positions[lane, agent.index] = np.nan
-        self.positions[new_lane, agent.index] = new_loc
+            self._index_remove(lane, loc, agent.index)
+            self._index_insert(new_lane, new_loc, agent.index)
+            self.lane_ids[agent.index] = new_lane
+        else:
+            self._index_update(lane, loc, new_loc, agent.index)
+        self.locs[agent.index] = new_loc
+        if loc < self.spawn_zone:
+            self.zone_counts[lane] -= 1
+        if new_loc < self.spawn_zone:
+            self.zone_counts[new_lane] += 1
         agent.pos = (new_loc, new_lane)
         return True
 
@@ -124,14 +168,76 @@ class LaneSpace:
         Args:
             agent (obj): An agent instance to be removed from the space.
         """
-        lane = agent.pos[1]
-        self.positions[lane, agent.index] = np.nan
+        loc, lane = agent.pos
+        self.locs[agent.index] = np.nan
+        self.lane_ids[agent.index] = -1
+        self._index_remove(lane, loc, agent.index)
+        self.free_slots.append(agent.index)
+        if loc < self.spawn_zone:
+            self.zone_counts[lane] -= 1
+
+    def get_free_lanes(self):
+        """
+        Determines for each lane if the spawn zone is empty, from the
+        counts which are kept up to date by the other methods.
+
+        Returns:
+            A boolean array with the value of each lane.
+        """
+        return np.array(self.zone_counts) == 0
+
+    def _index_find(self, lane, loc, index):
+        """
+        Private method to find the location of an agent in the sorted
+        index of a lane. Bisects to the position and walks over agents
+        which happen to share the exact same position.
+        """
+        slots = self.lane_slots[lane]
+        i = bisect_left(self.lane_index[lane], loc)
+        while slots[i] != index:
+            i += 1
+        return i
+
+    def _index_insert(self, lane, loc, index):
+        """
+        Private method to insert an agent in the sorted index of a lane.
+        """
+        i = bisect_right(self.lane_index[lane], loc)
+        self.lane_index[lane].insert(i, loc)
+        self.lane_slots[lane].insert(i, index)
+
+    def _index_remove(self, lane, loc, index):
+        """
+        Private method to remove an agent from the sorted index of a lane.
+        """
+        i = self._index_find(lane, loc, index)
+        del self.lane_index[lane][i]
+        del self.lane_slots[lane][i]
+
+    def _index_update(self, lane, loc, new_loc, index):
+        """
+        Private method to move an agent within a lane. As cars in the same
+        lane rarely overtake each other the position can almost always be
+        overwritten in place, the agent is only reinserted if it passed the
+        car in front, or the car behind as cars with a negative speed move
+        backwards.
+        """
+        row = self.lane_index[lane]
+        i = self._index_find(lane, loc, index)
+        if (i+1 == len(row) or new_loc <= row[i+1]) and \
+                (i == 0 or new_loc >= row[i-1]):
+            row[i] = new_loc
+            return
+        del row[i]
+        del self.lane_slots[lane][i]
+        self._index_insert(lane, new_loc, index)
 
     def get_neighbors(self, agent):
         """
         Returns the postition and speed of all 6 possible neighbours of a car:
         the cars in front and behind on the left, current, and right lane.
         Used to compute the utility of the possible move of an agent.
+        The closest cars are found by bisecting the sorted lane index.
 
         Args:
             agent (obj): An agent instance with a pos property.
@@ -147,24 +253,17 @@ class LaneSpace:
                   agent.model.length*2]
         backs = [-100, -100, -100]
 
+        loc, lane = agent.pos
         for i in range(0, 3):
-            j = agent.pos[1]-1+i
+            j = lane-1+i
             if 0 <= j < self.lanes:
-                # All cars in front of the current car
-                f_ind = self.positions[j][(agent.pos[0] <
-                                           self.positions[j]).nonzero()]
-                # All cars behind the current car
-                b_ind = self.positions[j][(agent.pos[0] >
-                                           self.positions[j]).nonzero()]
-
-                """
-                Directly using the min/max ufuncs is considerably faster
-                than the amin/amax numpy functions.
-                """
-                if len(f_ind):
-                    # The closest car in front
-                    fronts[i] = np.minimum.reduce(f_ind)
-                if len(b_ind):
-                    # The closest car behind
-                    backs[i] = np.maximum.reduce(b_ind)
+                row = self.lane_index[j]
+                # First car strictly in front of the current car
+                front = bisect_right(row, loc)
+                if front < len(row):
+                    fronts[i] = row[front]
+                # Last car strictly behind the current car
+                back = bisect_left(row, loc, 0, front)
+                if back:
+                    backs[i] = row[back-1]
         return fronts, backs
@@ -50,12 +50,114 @@ var LaneVisualization = function(width, height, context) {
 			context.strokeRect(x0, y0, dx, dy);
 	};
 
+	// Draws the cars of a packed frame, coloured from red to green by the
+	// speed bucket of each car
+	this.drawCars = function(cars, bucketWidth, radius) {
+		var y_scale = height / (cars.lanes + 1);
+		var x_scale = width / 65535;
+		var groups = [];
+		for (var b = 0; b < cars.buckets; b++)
+			groups.push([]);
+		for (var i = 0; i < cars.ids.length; i++)
+			groups[cars.bucket[i]].push(i);
+
+		for (var b = 0; b < cars.buckets; b++) {
+			if (!groups[b].length)
+				continue;
+			var speed = (b + 0.5) * bucketWidth;
+			context.fillStyle = "rgb(" + (140 - speed) + "," + (50 + speed) + ",0)";
+			context.beginPath();
+			for (var j = 0; j < groups[b].length; j++) {
+				var i = groups[b][j];
+				var cx = cars.x[i] * x_scale;
+				var cy = (cars.lanes - cars.lane[i]) * y_scale;
+				context.moveTo(cx + radius, cy);
+				context.arc(cx, cy, radius, 0, Math.PI * 2);
+			}
+			context.fill();
+		}
+	};
+
 	this.resetCanvas = function() {
 		context.clearRect(0, 0, width, height);
 		context.beginPath();
 	};
 };
 
+// Decodes the frames of PackedLaneCanvas, see lane_canvas.py for the layout,
+// and keeps the cars of the last frame to apply the next delta frame to.
+var FrameDecoder = function() {
+	var cars = null;
+	var frame = -1;
+
+	this.reset = function() {
+		cars = null;
+		frame = -1;
+	};
+
+	// Returns the cars after the frame, or null if the frame can not be
+	// applied because a previous frame was missed.
+	this.decode = function(encoded) {
+		var raw = atob(encoded);
+		var bytes = new Uint8Array(raw.length);
+		for (var i = 0; i < raw.length; i++)
+			bytes[i] = raw.charCodeAt(i);
+		var buffer = bytes.buffer;
+
+		var header = new Uint32Array(buffer, 0, 8);
+		var n = header[1], delta = header[2] == 1;
+		var removed = header[3], kept = header[4], added = header[5];
+		if (delta && (cars === null || n != frame + 1))
+			return null;
+
+		var offset = 32;
+		var removedIds = new Uint32Array(buffer, offset, removed);
+		offset += 4 * removed;
+		var addedIds = new Uint32Array(buffer, offset, added);
+		offset += 4 * added;
+		var addedX = new Uint16Array(buffer, offset, added);
+		offset += 2 * added;
+		var keptDx = new Int16Array(buffer, offset, kept);
+		offset += 2 * kept;
+		var addedLane = new Uint8Array(buffer, offset, added);
+		offset += added;
+		var addedBucket = new Uint8Array(buffer, offset, added);
+		offset += added;
+		var keptLane = new Uint8Array(buffer, offset, kept);
+		offset += kept;
+		var keptBucket = new Uint8Array(buffer, offset, kept);
+
+		var total = kept + added;
+		var next = {ids: new Uint32Array(total), x: new Int32Array(total),
+					lane: new Uint8Array(total), bucket: new Uint8Array(total),
+					lanes: header[6], buckets: header[7]};
+		if (delta) {
+			// The remaining cars keep their order, skip the removed ones
+			var r = 0, k = 0;
+			for (var i = 0; i < cars.ids.length; i++) {
+				if (r < removed && cars.ids[i] == removedIds[r]) {
+					r++;
+					continue;
+				}
+				next.ids[k] = cars.ids[i];
+				next.x[k] = cars.x[i] + keptDx[k];
+				next.lane[k] = keptLane[k];
+				next.bucket[k] = keptBucket[k];
+				k++;
+			}
+		}
+		for (var i = 0; i < added; i++) {
+			next.ids[kept + i] = addedIds[i];
+			next.x[kept + i] = addedX[i];
+			next.lane[kept + i] = addedLane[i];
+			next.bucket[kept + i] = addedBucket[i];
+		}
+		cars = next;
+		frame = n;
+		return cars;
+	};
+};
+
 var Lane_Module = function(canvas_width, canvas_height) {
 
 	var canvas_width = canvas_width;
@@ -71,13 +173,24 @@ var Lane_Module = function(canvas_width, canvas_height) {
 	// Create the context and the drawing controller:
 	var context = canvas.getContext("2d");
 	var canvasDraw = new LaneVisualization(canvas_width, canvas_height, context);
+	var decoder = new FrameDecoder();
 
 	this.render = function(data) {
+		if (data && data.frame !== undefined) {
+			// Packed frames keep the last drawing until a keyframe arrives
+			var cars = decoder.decode(data.frame);
+			if (cars === null)
+				return;
+			canvasDraw.resetCanvas();
+			canvasDraw.drawCars(cars, data.bucket_width, 4);
+			return;
+		}
 		canvasDraw.resetCanvas();
 		canvasDraw.draw(data);
 	};
 
 	this.reset = function() {
+		decoder.reset();
 		canvasDraw.resetCanvas();
 	};
 
@@ -3,12 +3,13 @@ Creates the general road model in which the car agents reside.
 """
 import numpy as np
 from mesa import Model
-from mesa.time import RandomActivation
-from mesa.datacollection import DataCollector
 import cargrid as car
 from lane_grid import LaneSpace
-from data_collection import avg_speed, cars_in_lane, track_params
-from data_collection import track_run, avg_slowdown
+from vector_engine import VectorEngine
+from road_schedule import RoadSchedule
+from random_stream import spawn_streams
+from road_collector import RoadCollector, ConvergenceMonitor
+from profiler import StepProfiler
 np.warnings.filterwarnings('ignore')
 
 
@@ -36,17 +37,43 @@ class RoadSim(Model):
         min_gap (float): Minimal gap the car agents maintain.
         grid (obj): Instance of the LaneSpace class, contains
             the grid with all cars' locations.
-        schedule (obj): Instance of the mesa scheduler.
+        schedule (obj): Instance of the RoadSchedule scheduler.
         speed (float): Speed of the cars in m/s
-        cars (list): List of all car agent objects.
-        datacollector (obj): Mesa datacollector object to
-            report data during a simulation.
+        cars (list): List of all car agent objects, read from the schedule.
+        datacollector (obj): RoadCollector object to report data
+            during a simulation.
+        engine (str): Either 'agent' to step each car agent through the
+            mesa scheduler, 'vector' to step all cars at once, or 'kernel'
+            to step all cars in compiled loops.
+        road (obj): Instance of the VectorEngine class which holds all
+            cars if the vector or kernel engine is used, None otherwise.
+        slowdown (str): How car agents without a possible move slow down,
+            'loop' in small random steps or 'direct' in a single step.
+        seed (int): Seed of all random streams of the model.
+        spawn_rng (obj): RandomStream used to spawn new cars.
+        car_rng (obj): RandomStream used for the attributes and decisions
+            of the cars.
+        order_rng (obj): RandomStream used for the activation order.
+        monitor (obj): ConvergenceMonitor which stops the run once the
+            collected data has converged, None to run until stopped.
+        slowdown_loops (int): Number of times a car found no possible move
+            and slowed down, the iterations of the get_move loop after the
+            first. Not counted by the kernel engine.
+        profiler (obj): StepProfiler with the timings and counters of each
+            step if profiling is enabled, None otherwise.
+        recorder (obj): TrajectoryRecorder which records the cars every
+            step, set by the recorder, None otherwise.
+        params (dict): The arguments the model was created with, used to
+            recreate the model from a snapshot.
     """
     # pylint: disable=too-many-instance-attributes
     # pylint: disable=too-many-arguments
 
     def __init__(self, lanes=3, length=5000, spawn=0.4, agression=0.1,
-                 speed=100, time_step=0.1, min_gap=1.6):
+                 speed=100, time_step=0.1, min_gap=1.6, engine='agent',
+                 slowdown='loop', order='random', seed=None,
+                 collect_stride=1, warmup=0.0, max_steps=None,
+                 keep_series=True, convergence=None, profile=False):
         """
         Args:
             lanes (int): number of lanes
@@ -57,8 +84,48 @@ class RoadSim(Model):
             speed (float): general speed of the car agents in km/h
             time_step (float): time in seconds to be advanced each step
             min_gap (float): minimum gap cars maintain in meters
+            engine (str): 'agent' to step the car agents one by one,
+                'vector' to step all cars at once with array operations, or
+                'kernel' to step all cars with the compiled kernels.
+            slowdown (str): 'loop' to let car agents without a possible
+                move slow down in small random steps until a move is
+                possible, or 'direct' to slow down to below the speed at
+                which a move becomes possible at once.
+            order (str): activation order of the car agents: 'random',
+                'front' to start with the car furthest along the road or
+                'back' to start with the car closest to the start.
+            seed (int): seed of the random streams, runs with the same
+                parameters and seed are identical. None seeds the streams
+                from the operating system.
+            collect_stride (int): number of steps between data collections.
+            warmup (float): fraction of max_steps excluded from the summary
+                statistics of the data collector.
+            max_steps (int): the planned number of steps of the run, only
+                needed to determine the warm-up.
+            keep_series (bool): store the collected data of every step,
+                otherwise the collector only keeps summary statistics.
+            convergence (dict): arguments of the ConvergenceMonitor which
+                stops the run once the average speed and cars per lane
+                after the warm-up have converged, True for the defaults, or
+                None to not monitor the run.
+            profile (bool): attach a StepProfiler to time the phases of
+                each step, 'steps' to also record a row for every step.
         """
+        if engine not in ('agent', 'vector', 'kernel'):
+            raise ValueError(f"unknown engine '{engine}'")
+        if slowdown not in ('loop', 'direct'):
+            raise ValueError(f"unknown slowdown '{slowdown}'")
+        if warmup and max_steps is None:
+            raise ValueError("a warmup requires max_steps")
         super().__init__()
+        self.params = {'lanes': lanes, 'length': length, 'spawn': spawn,
+                       'agression': agression, 'speed': speed,
+                       'time_step': time_step, 'min_gap': min_gap,
+                       'engine': engine, 'slowdown': slowdown,
+                       'order': order, 'seed': seed,
+                       'collect_stride': collect_stride, 'warmup': warmup,
+                       'max_steps': max_steps, 'keep_series': keep_series,
+                       'convergence': convergence, 'profile': profile}
         self.uid = hash((spawn, agression, lanes))
         self.current_id = 0
         self.length = int(length)
@@ -67,21 +134,36 @@ class RoadSim(Model):
         self.time_step = time_step
         self.agression = agression
         self.min_gap = min_gap
+        self.engine = engine
+        self.slowdown = slowdown
+        self.seed = seed
+        streams = spawn_streams(seed, ('spawn', 'car', 'order'))
+        self.spawn_rng = streams['spawn']
+        self.car_rng = streams['car']
+        self.order_rng = streams['order']
+        self.road = None
+        if engine != 'agent':
+            self.road = VectorEngine(self, kernel=engine == 'kernel')
 
+        self.speed = speed/3.6
         self.grid = LaneSpace(self.length, self.lanes, self.time_step,
-                              scale=0.5)
+                              scale=0.02,
+                              spawn_zone=self.speed*self.time_step)
 
-        self.schedule = RandomActivation(self)
-        self.speed = speed/3.6
-        self.cars = []
-        self.datacollector = DataCollector(
-            model_reporters={
-                "Avg_speed": avg_speed,
-                'Cars_in_lane': cars_in_lane,
-                'Avg_slowdown': avg_slowdown,
-                'Model Params': track_params,
-                'Run': track_run}
-            )
+        self.schedule = RoadSchedule(self, order)
+        self.monitor = None
+        if convergence:
+            self.monitor = ConvergenceMonitor(
+                **(convergence if isinstance(convergence, dict) else {}))
+        self.datacollector = RoadCollector(
+            self, stride=collect_stride, warmup=int(warmup*(max_steps or 0)),
+            keep_series=keep_series, monitor=self.monitor)
+        self.slowdown_loops = 0
+        self.recorder = None
+        self.profiler = None
+        if profile:
+            self.profiler = StepProfiler(record_steps=profile == 'steps')
+            self.profiler.attach(self)
         # Initialize 2 cars
         self.new_car()
         self.new_car(start_lane=1)
@@ -89,39 +171,57 @@ class RoadSim(Model):
     def get_free_lanes(self):
         """
         Determines if each lane has enough space for a car to spawn: should
-        be at least the speed of the car.
+        be at least the speed of the car. The grid counts the cars in this
+        spawn zone, so this does not depend on the number of cars.
 
         Returns:
             A boolean array with the value of each lane.
         """
-        return np.count_nonzero(self.grid.positions <
-                                self.speed*self.time_step, axis=1) == 0
+        if self.road is not None:
+            return self.road.get_free_lanes()
+        return self.grid.get_free_lanes()
 
     def init_cars(self):
         """
-        Loops over all lanes and randomly creates a new car object if
-        sufficient space is available.
+        Randomly creates new cars on all lanes where sufficient space is
+        available. The spawn chances of all lanes are drawn at once.
         """
         free_lanes = self.get_free_lanes()
-        for i in range(self.lanes):
-            if free_lanes[i] and np.random.rand()\
-             < (self.spawn_chance*self.time_step):
-                self.new_car(i)
+        spawn = free_lanes & (self.spawn_rng.random(self.lanes) <
+                              self.spawn_chance*self.time_step)
+        if spawn.any():
+            self.new_cars(spawn.nonzero()[0])
 
     def new_car(self, start_lane=0):
         """
-        Generates a new car object and adds it to the model scheduler.
-        If the index of the agent is already occupied in the lane grid
-        a new one is generated.
+        Generates a new car object, places it on the lane grid and
+        adds it to the model scheduler.
         """
-        new_car = car.Car(self.next_id(), self, start_lane, self.speed,
-                          self.agression, self.min_gap)
+        self.new_cars([start_lane])
 
-        while not self.grid.place_agent(new_car):
-            new_car = car.Car(self.next_id(), self, start_lane, self.speed,
-                              self.agression, self.min_gap)
-        self.cars.append(new_car)
-        self.schedule.add(new_car)
+    def new_cars(self, start_lanes):
+        """
+        Generates a new car in each of the given lanes. The maximum speed
+        and gap of all new cars are drawn at once, after which the cars are
+        placed on the lane grid and added to the model scheduler.
+
+        Args:
+            start_lanes (list): The start lane of each new car.
+        """
+        if self.road is not None:
+            self.road.add_cars(start_lanes)
+            return
+        n = len(start_lanes)
+        max_speeds = self.speed + \
+            np.abs(self.car_rng.standard_normal(n))*self.agression
+        gaps = self.car_rng.random(n) / self.agression + self.min_gap
+        for lane, max_speed, gap in zip(np.asarray(start_lanes).tolist(),
+                                        max_speeds, gaps):
+            new_car = car.Car(self.next_id(), self, lane, self.speed,
+                              self.agression, self.min_gap,
+                              max_speed=max_speed, gap=gap)
+            self.grid.place_agent(new_car)
+            self.schedule.add(new_car)
 
     def move(self, agent, new_lane):
         """
@@ -133,13 +233,85 @@ class RoadSim(Model):
         if not has_moved:
             self.grid.remove_agent(agent)
             self.schedule.remove(agent)
-            self.cars.remove(agent)
+
+    @property
+    def cars(self):
+        """
+        List of all car agent objects on the road.
+        """
+        return self.schedule.agents
+
+    def get_speeds(self):
+        """
+        Returns the current and maximum speed of all cars on the road.
+
+        Returns:
+            speeds (array): The current speed of each car in m/s.
+            max_speeds (array): The maximum speed of each car in m/s.
+        """
+        if self.road is not None:
+            return self.road.speed, self.road.max_speed
+        speeds = np.array([(agent.speed, agent.max_speed)
+                           for agent in self.schedule.agents]).reshape(-1, 2)
+        return speeds[:, 0], speeds[:, 1]
+
+    def get_cars(self):
+        """
+        Returns the state of all cars on the road.
+
+        Returns:
+            uid (array): The unique id of each car.
+            lane (array): The lane of each car.
+            loc (array): The position of each car in meters.
+            speed (array): The current speed of each car in m/s.
+        """
+        if self.road is not None:
+            road = self.road
+            return road.uid, road.lane, road.loc, road.speed
+        agents = self.schedule.agents
+        uid = np.fromiter((agent.unique_id for agent in agents), dtype=int,
+                          count=len(agents))
+        lane = np.fromiter((agent.pos[1] for agent in agents), dtype=int,
+                           count=len(agents))
+        loc = np.fromiter((agent.pos[0] for agent in agents), dtype=float,
+                          count=len(agents))
+        speed = np.fromiter((agent.speed for agent in agents), dtype=float,
+                            count=len(agents))
+        return uid, lane, loc, speed
+
+    def get_lane_counts(self):
+        """
+        Returns the number of cars in each lane.
+        """
+        if self.road is not None:
+            lanes = self.road.lane
+        else:
+            lanes = [agent.pos[1] for agent in self.schedule.agents]
+        return np.bincount(lanes, minlength=self.lanes)
+
+    def get_car_count(self):
+        """
+        Returns the number of cars on the road.
+        """
+        if self.road is not None:
+            return self.road.count
+        return self.schedule.get_agent_count()
 
     def step(self):
         """
         Step method for the mesa scheduler. Moves the car agents, initializes
-        new cars, and collects model data in order.
+        new cars, and collects and records model data in order. Stops the run once the
+        convergence monitor has converged.
         """
-        self.schedule.step()
+        if self.road is not None:
+            self.road.step()
+            self.schedule.steps += 1
+            self.schedule.time += 1
+        else:
+            self.schedule.step()
         self.init_cars()
         self.datacollector.collect(self)
+        if self.recorder is not None:
+            self.recorder.record(self)
+        if self.monitor is not None and self.monitor.stop_step is not None:
+            self.running = False
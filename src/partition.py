@@ -0,0 +1,400 @@
+""" Module for domain decomposed runs of very long roads.
+Splits the road into longitudinal segments which are stepped in parallel by
+worker processes. The processes exchange the cars at the segment edges
+through shared memory every step, so a run scales with the number of cores
+instead of being limited to a single process.
+"""
+import os
+import traceback
+import multiprocessing as mp
+from threading import BrokenBarrierError
+import numpy as np
+from modelgrid import RoadSim
+from road_collector import RoadCollector, ConvergenceMonitor
+from vector_engine import VectorEngine
+
+"""
+Commands of the PartitionedRoad to its segment workers.
+"""
+STEP, CARS, STOP = 0, 1, 2
+
+
+class SegmentEngine(VectorEngine):
+    """
+    VectorEngine holding the cars of one segment of a partitioned road,
+    the cars with a position in [start, end). The neighbours of the cars
+    are looked up in the segment and in the ghosts: for every lane the
+    closest car ahead of and behind the segment, published by the other
+    segments. As a neighbour lookup only returns the closest car in each
+    lane, the ghosts give the exact same neighbours as the whole road.
+
+    Attributes:
+        start (float): Start of the segment in meters.
+        end (float): End of the segment in meters.
+        ghost_fronts (array): Position of the closest car ahead of the
+            segment in each lane, nan if there is none.
+        ghost_backs (array): Position of the closest car behind the
+            segment in each lane, nan if there is none.
+    """
+
+    def __init__(self, model, start, end, kernel=False):
+        """
+        Args:
+            model (obj): The RoadSim instance hosting the engine.
+            start (float): Start of the segment in meters.
+            end (float): End of the segment in meters.
+            kernel (bool): Use the compiled kernels to decide the moves.
+        """
+        super().__init__(model, kernel=kernel)
+        self.start = start
+        self.end = end
+        self.ghost_fronts = np.full(model.lanes, np.nan)
+        self.ghost_backs = np.full(model.lanes, np.nan)
+
+    def get_neighbors(self):
+        """
+        Version of VectorEngine.get_neighbors which falls back on the ghosts
+        where a car has no neighbour in the segment.
+        """
+        fronts, backs = super().get_neighbors()
+        lanes = self.lane[:, None] + np.array([-1, 0, 1])
+        valid = (lanes >= 0) & (lanes < self.model.lanes)
+        lanes = np.clip(lanes, 0, self.model.lanes-1)
+
+        ghosts = self.ghost_fronts[lanes]
+        use = valid & (fronts == self.model.length*2.0) & ~np.isnan(ghosts)
+        fronts[use] = ghosts[use]
+        ghosts = self.ghost_backs[lanes]
+        use = valid & (backs == -100.0) & ~np.isnan(ghosts)
+        backs[use] = ghosts[use]
+        return fronts, backs
+
+    def take_leaving(self):
+        """
+        Removes the cars which have moved out of the segment.
+
+        Returns:
+            An (n, columns) array with the columns of the leaving cars.
+        """
+        leaving = (self.loc < self.start) | (self.loc >= self.end)
+        records = np.column_stack([getattr(self, name)[leaving]
+                                   for name in self.columns])
+        self._keep(~leaving)
+        return records
+
+    def adopt(self, records):
+        """
+        Adds the cars which have moved into the segment.
+
+        Args:
+            records (array): An (n, columns) array, see take_leaving.
+        """
+        for i, name in enumerate(self.columns):
+            column = getattr(self, name)
+            setattr(self, name, np.concatenate((column, records[:, i]))
+                    .astype(column.dtype))
+
+    def get_edges(self):
+        """
+        Returns the position of the last and first car in each lane, the
+        ghosts of the other segments, nan for empty lanes.
+
+        Returns:
+            A (lanes, 2) array with the smallest and largest position.
+        """
+        edges = np.full((self.model.lanes, 2), np.nan)
+        if self.count:
+            order = np.lexsort((self.loc, self.lane))
+            lane = self.lane[order]
+            loc = self.loc[order]
+            first = np.r_[True, lane[1:] != lane[:-1]]
+            last = np.r_[lane[1:] != lane[:-1], True]
+            edges[lane[first], 0] = loc[first]
+            edges[lane[last], 1] = loc[last]
+        return edges
+
+
+def _view(raw, shape):
+    """
+    Private function which returns a float array on a shared buffer.
+    """
+    return np.frombuffer(raw, dtype=float).reshape(shape)
+
+
+def _run_segment(index, bounds, params, kernel, capacity, shared, barriers,
+                 conn):
+    """
+    Private function which runs the segment of a worker process. Every step
+    the worker reads the ghosts, steps its cars, spawns new cars if it is
+    the first segment, writes the cars which left the segment to its outbox
+    and, after all workers did so, adopts the cars sent to it and publishes
+    its edges and totals. Errors are sent to the PartitionedRoad, and break
+    the barriers so no process keeps waiting.
+    """
+    segments = len(bounds) - 1
+    lanes = params['lanes']
+    columns = len(VectorEngine.columns)
+    control = shared['control']
+    ghosts = _view(shared['ghosts'], (segments, lanes, 2))
+    outbox = _view(shared['outbox'], (segments, capacity, columns + 1))
+    sent = _view(shared['sent'], (segments,))
+    totals = _view(shared['totals'], (segments, 4 + lanes))
+    stepping, moved, published = barriers
+
+    def publish():
+        ghosts[index] = road.get_edges()
+        totals[index, :4] = (road.count, np.sum(road.speed),
+                             np.sum(road.max_speed), model.slowdown_loops)
+        totals[index, 4:] = np.bincount(road.lane, minlength=lanes)
+
+    try:
+        model = RoadSim(**params)
+        road = SegmentEngine(model, bounds[index], bounds[index+1], kernel)
+        if index == 0:
+            for name in road.columns:
+                setattr(road, name, getattr(model.road, name))
+        model.road = road
+        publish()
+        published.wait()
+        while True:
+            stepping.wait()
+            if control[0] == STOP:
+                return
+            if control[0] == CARS:
+                conn.send((road.uid, road.lane, road.loc, road.speed))
+                continue
+
+            road.ghost_fronts = np.fmin.reduce(ghosts[index+1:, :, 0],
+                                               axis=0, initial=np.nan)
+            road.ghost_backs = np.fmax.reduce(ghosts[:index, :, 1],
+                                              axis=0, initial=np.nan)
+            road.step()
+            if index == 0:
+                model.init_cars()
+            leaving = road.take_leaving()
+            if len(leaving) > capacity:
+                raise ValueError(f"{len(leaving)} cars left segment {index}"
+                                 f" in one step, the capacity is {capacity}")
+            outbox[index, :len(leaving), :columns] = leaving
+            outbox[index, :len(leaving), columns] = np.searchsorted(
+                bounds, leaving[:, 1], side='right') - 1
+            sent[index] = len(leaving)
+            moved.wait()
+
+            for source in range(segments):
+                records = outbox[source, :int(sent[source])]
+                records = records[records[:, columns] == index, :columns]
+                if len(records):
+                    road.adopt(records)
+            publish()
+            published.wait()
+    except BrokenBarrierError:
+        pass
+    except Exception:  # pylint: disable=broad-except
+        conn.send(traceback.format_exc())
+        for barrier in barriers:
+            barrier.abort()
+
+
+class PartitionedRoad:
+    """
+    Runs the vector engine on a road which is split into segments of equal
+    length, each stepped by its own worker process. All segments step in
+    lock step, deciding on the positions at the start of the step as the
+    vector engine does, with the closest cars of the other segments as
+    ghosts. Cars which cross a segment edge are handed off through shared
+    memory, new cars spawn in the first segment and cars leave the road in
+    the last.
+
+    Every segment draws from its own random streams, so a partitioned run
+    does not reproduce a single process run with the same seed, but follows
+    the same distribution, see validation.compare_partitioned. The workers
+    send the totals of each step to the PartitionedRoad, which collects them
+    in a RoadCollector, so the collector, convergence monitor and summary
+    are the same as those of a RoadSim.
+
+    The segments should be long compared to the distance a car travels in a
+    step, at least a few hundred meters. Close the road, or use it as a
+    context manager, to stop the worker processes.
+
+    Attributes:
+        lanes (int): Number of lanes.
+        length (int): Length of the road in meters.
+        spawn_chance (float): Spawn probability of a car on each lane.
+        agression (float): Agression of the cars.
+        uid (int): Hash of the parameters, as RoadSim.uid.
+        segments (int): Number of segments and worker processes.
+        bounds (array): The segment edges, the first and last are infinite.
+        steps (int): Number of steps taken.
+        running (bool): False once the convergence monitor has converged.
+        monitor (obj): ConvergenceMonitor of the run, or None.
+        datacollector (obj): RoadCollector of the run.
+        slowdown_loops (int): Total slowdown iterations of all segments.
+    """
+    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, lanes=3, length=50000, spawn=0.4, agression=0.1,
+                 speed=100, time_step=0.1, min_gap=1.6, engine='vector',
+                 segments=None, seed=None, collect_stride=1, warmup=0.0,
+                 max_steps=None, keep_series=True, convergence=None,
+                 capacity=1024):
+        """
+        Args:
+            lanes, length, spawn, agression, speed, time_step, min_gap,
+                collect_stride, warmup, max_steps, keep_series, convergence:
+                See RoadSim.
+            engine (str): 'vector' or 'kernel', the engine of the segments.
+            segments (int): Number of segments, the number of cores if None.
+            seed (int): Seed from which the seeds of the random streams of
+                the segments are derived.
+            capacity (int): Maximum number of cars which can leave a
+                segment in a single step.
+        """
+        if engine not in ('vector', 'kernel'):
+            raise ValueError(f"unknown engine '{engine}' for a partitioned "
+                             "road")
+        if warmup and max_steps is None:
+            raise ValueError("a warmup requires max_steps")
+        self.lanes = lanes
+        self.length = int(length)
+        self.spawn_chance = spawn
+        self.agression = agression
+        self.uid = hash((spawn, agression, lanes))
+        self.segments = segments or os.cpu_count()
+        self.bounds = np.linspace(0, self.length, self.segments + 1)
+        self.bounds[0] = -np.inf
+        self.bounds[-1] = np.inf
+        self.steps = 0
+        self.running = True
+        self.slowdown_loops = 0
+        self.monitor = None
+        if convergence:
+            self.monitor = ConvergenceMonitor(
+                **(convergence if isinstance(convergence, dict) else {}))
+        self.datacollector = RoadCollector(
+            self, stride=collect_stride, warmup=int(warmup*(max_steps or 0)),
+            keep_series=keep_series, monitor=self.monitor)
+
+        seeds = np.random.SeedSequence(seed).generate_state(self.segments,
+                                                            np.uint64)
+        columns = len(VectorEngine.columns)
+        self._shared = {
+            'control': mp.RawArray('i', 1),
+            'ghosts': mp.RawArray('d', self.segments*lanes*2),
+            'outbox': mp.RawArray('d', self.segments*capacity*(columns+1)),
+            'sent': mp.RawArray('d', self.segments),
+            'totals': mp.RawArray('d', self.segments*(4+lanes))}
+        self._totals = _view(self._shared['totals'],
+                             (self.segments, 4+lanes))
+        self._barriers = (mp.Barrier(self.segments + 1),
+                          mp.Barrier(self.segments),
+                          mp.Barrier(self.segments + 1))
+        self._conns = []
+        self._workers = []
+        for index in range(self.segments):
+            params = {'lanes': lanes, 'length': length, 'spawn': spawn,
+                      'agression': agression, 'speed': speed,
+                      'time_step': time_step, 'min_gap': min_gap,
+                      'engine': 'vector', 'seed': int(seeds[index]),
+                      'keep_series': False}
+            receiver, sender = mp.Pipe(duplex=False)
+            worker = mp.Process(
+                target=_run_segment, daemon=True,
+                args=(index, self.bounds, params, engine == 'kernel',
+                      capacity, self._shared, self._barriers, sender))
+            worker.start()
+            self._conns.append(receiver)
+            self._workers.append(worker)
+        self._wait(self._barriers[2])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _wait(self, barrier):
+        """
+        Private method which waits on a barrier, and raises the error of a
+        worker if a worker failed.
+        """
+        try:
+            barrier.wait()
+        except BrokenBarrierError:
+            errors = [conn.recv() for conn in self._conns if conn.poll()]
+            self.close()
+            raise RuntimeError("a segment worker failed:\n" +
+                               "\n".join(errors)) from None
+
+    def _command(self, command):
+        """
+        Private method which starts a command in all workers.
+        """
+        if not self._workers:
+            raise RuntimeError("the partitioned road is closed")
+        self._shared['control'][0] = command
+        self._wait(self._barriers[0])
+
+    def step(self):
+        """
+        Advances all segments by one step and collects the totals. Stops the
+        run once the convergence monitor has converged.
+        """
+        self._command(STEP)
+        self._wait(self._barriers[2])
+        totals = self._totals.sum(axis=0)
+        self.slowdown_loops = int(totals[3])
+        self.datacollector.collect_totals(int(totals[0]), totals[1],
+                                          totals[2], self.lanes)
+        self.steps += 1
+        if self.monitor is not None and self.monitor.stop_step is not None:
+            self.running = False
+
+    def run(self, max_steps):
+        """
+        Steps the road until max_steps or until the run is stopped.
+
+        Returns:
+            The RoadCollector of the run.
+        """
+        while self.running and self.steps < max_steps:
+            self.step()
+        return self.datacollector
+
+    def get_car_count(self):
+        """
+        Returns the number of cars on the road.
+        """
+        return int(self._totals[:, 0].sum())
+
+    def get_lane_counts(self):
+        """
+        Returns the number of cars in each lane.
+        """
+        return self._totals[:, 4:].sum(axis=0).astype(int)
+
+    def get_cars(self):
+        """
+        Gathers the state of all cars from the workers, see RoadSim.get_cars.
+        The cars are ordered by segment.
+        """
+        self._command(CARS)
+        parts = [conn.recv() for conn in self._conns]
+        return tuple(np.concatenate(column) for column in zip(*parts))
+
+    def close(self):
+        """
+        Stops the worker processes.
+        """
+        if not self._workers:
+            return
+        if all(worker.is_alive() for worker in self._workers) and \
+                not self._barriers[0].broken:
+            self._shared['control'][0] = STOP
+            self._barriers[0].wait()
+        for worker in self._workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
@@ -0,0 +1,172 @@
+""" Module for profiling the steps of the road model.
+Times the phases of every step and counts the events which make a step
+expensive, without touching the model unless profiling is enabled.
+"""
+from time import perf_counter
+import pandas as pd
+
+
+class StepProfiler:
+    """
+    Opt-in instrumentation of a RoadSim. Attaching the profiler replaces
+    methods of the model, its grid, engine and data collector with timing
+    and counting wrappers on those instances only, so other models and the
+    classes themselves are unaffected.
+
+    The phases of a step are the neighbour lookups, the grid moves, the
+    spawning of new cars, the data collection and the decisions of the
+    cars, which is the remaining time of the step. The vector engines move
+    all cars in the same pass in which they decide, so their move time is
+    part of the decisions.
+
+    The counters are the cars on the road, the slowdown iterations of the
+    get_move loop, the cars placed on the grid, the resizes of the grid and
+    the cars removed from the grid. The vector engines do not use the grid,
+    so only their placed cars are counted, and the kernel engine does not
+    count its slowdown iterations. The neighbour lookups and moves of the
+    agent engine are timed for every car, which makes profiled agent runs
+    noticeably slower than unprofiled ones.
+
+    Attributes:
+        record_steps (bool): Keep a row with the phases and counters of
+            every step, see table.
+        steps (int): Number of profiled steps.
+        time (float): Total time of the profiled steps in seconds.
+        phases (dict): Total seconds of each phase.
+        counters (dict): Total count of each counter.
+        rows (list): The row of each step if record_steps is set.
+    """
+    phase_names = ('decide', 'neighbors', 'move', 'spawn', 'collect')
+    counter_names = ('cars', 'slowdown_loops', 'placements', 'resizes',
+                     'removals')
+
+    def __init__(self, record_steps=False):
+        """
+        Args:
+            record_steps (bool): Keep a row with the phases and counters of
+                every step.
+        """
+        self.record_steps = record_steps
+        self.steps = 0
+        self.time = 0.0
+        self.phases = dict.fromkeys(self.phase_names, 0.0)
+        self.counters = dict.fromkeys(self.counter_names, 0)
+        self.rows = []
+        self._phases = dict.fromkeys(self.phase_names, 0.0)
+        self._counters = dict.fromkeys(self.counter_names, 0)
+
+    def _timed(self, phase, method):
+        """
+        Private method which wraps a method to add its time to a phase.
+        """
+        phases = self._phases
+
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                phases[phase] += perf_counter() - start
+        return timed
+
+    def _counted(self, counter, method, size=None):
+        """
+        Private method which wraps a method to count its calls, or the
+        length of an argument if size gives its position.
+        """
+        counters = self._counters
+
+        def counted(*args, **kwargs):
+            counters[counter] += 1 if size is None else len(args[size])
+            return method(*args, **kwargs)
+        return counted
+
+    def attach(self, model):
+        """
+        Instruments a model, called by RoadSim when profiling is enabled.
+
+        Args:
+            model (obj): The RoadSim instance to profile.
+        """
+        model.step = self._profiled_step(model, model.step)
+        model.init_cars = self._timed('spawn', model.init_cars)
+        collector = model.datacollector
+        collector.collect = self._timed('collect', collector.collect)
+        if model.road is not None:
+            road = model.road
+            road.get_neighbors = self._timed('neighbors', road.get_neighbors)
+            road.add_cars = self._counted('placements', road.add_cars, 0)
+            return
+        grid = model.grid
+        model.move = self._timed('move', model.move)
+        grid.get_neighbors = self._timed('neighbors', grid.get_neighbors)
+        grid.place_agent = self._counted('placements', grid.place_agent)
+        grid._resize_grid = self._counted('resizes', grid._resize_grid)
+        grid.remove_agent = self._counted('removals', grid.remove_agent)
+
+    def _profiled_step(self, model, step):
+        """
+        Private method which wraps RoadSim.step to time the whole step and
+        add the phases and counters of the step to the totals.
+        """
+        def profiled_step():
+            loops = model.slowdown_loops
+            start = perf_counter()
+            step()
+            elapsed = perf_counter() - start
+            self._counters['slowdown_loops'] = model.slowdown_loops - loops
+            self._counters['cars'] = model.get_car_count()
+            self._phases['decide'] = elapsed - sum(
+                self._phases[phase] for phase in self.phase_names[1:])
+            self._finish_step(elapsed)
+        return profiled_step
+
+    def _finish_step(self, elapsed):
+        """
+        Private method which adds the phases and counters of a step to the
+        totals, and resets them in place for the next step, as the wrappers
+        hold on to the dictionaries.
+        """
+        self.steps += 1
+        self.time += elapsed
+        for phase, seconds in self._phases.items():
+            self.phases[phase] += seconds
+        for counter, count in self._counters.items():
+            self.counters[counter] += count
+        if self.record_steps:
+            row = {'step': self.steps, 'time': elapsed}
+            row.update(self._phases)
+            row.update(self._counters)
+            self.rows.append(row)
+        for phase in self._phases:
+            self._phases[phase] = 0.0
+        for counter in self._counters:
+            self._counters[counter] = 0
+
+    def summary(self):
+        """
+        Returns the totals of the profiled steps.
+
+        Returns:
+            A dictionary with the number of steps, the total time, the
+            seconds and fraction of the time of each phase, the total of
+            each counter and the mean of each counter per step.
+        """
+        steps = max(self.steps, 1)
+        return {'steps': self.steps,
+                'time': self.time,
+                'phases': dict(self.phases),
+                'fractions': {phase: seconds / self.time if self.time else 0.0
+                              for phase, seconds in self.phases.items()},
+                'counters': dict(self.counters),
+                'per_step': {counter: count / steps
+                             for counter, count in self.counters.items()}}
+
+    def table(self):
+        """
+        Returns a DataFrame with a row for each profiled step, with the time
+        of the step and of each phase in seconds and the counters of the
+        step. Requires record_steps.
+        """
+        return pd.DataFrame(self.rows, columns=['step', 'time'] +
+                            list(self.phase_names) + list(self.counter_names))
@@ -0,0 +1,81 @@
+""" Module for the random number streams of the model.
+Each model owns its own numpy Generators, derived from a single seed, so
+runs can be reproduced and run side by side in one process.
+"""
+import numpy as np
+
+
+class RandomStream:
+    """
+    Wraps a numpy Generator for a single consumer of random numbers in the
+    model. Scalar draws are taken from blocks which are generated at once,
+    as a single call for a block is much cheaper than a call for each
+    number. Array draws are passed on to the generator directly.
+
+    Attributes:
+        generator (obj): The numpy Generator of the stream.
+        block_size (int): Number of scalars generated at once.
+    """
+
+    def __init__(self, seed, block_size=1024):
+        """
+        Args:
+            seed (obj): Seed of the generator, an integer or a numpy
+                SeedSequence.
+            block_size (int): Number of scalars generated at once.
+        """
+        self.generator = np.random.default_rng(seed)
+        self.block_size = block_size
+        self._uniform = []
+        self._normal = []
+
+    def rand(self):
+        """
+        Returns a single uniform number in [0, 1).
+        """
+        if not self._uniform:
+            self._uniform = self.generator.random(self.block_size).tolist()
+        return self._uniform.pop()
+
+    def randn(self):
+        """
+        Returns a single number from the standard normal distribution.
+        """
+        if not self._normal:
+            self._normal = self.generator.standard_normal(
+                self.block_size).tolist()
+        return self._normal.pop()
+
+    def random(self, size):
+        """
+        Returns an array of uniform numbers in [0, 1) of the given shape.
+        """
+        return self.generator.random(size)
+
+    def standard_normal(self, size):
+        """
+        Returns an array of standard normal numbers of the given shape.
+        """
+        return self.generator.standard_normal(size)
+
+    def permutation(self, n):
+        """
+        Returns a random permutation of the integers 0 to n-1.
+        """
+        return self.generator.permutation(n)
+
+
+def spawn_streams(seed, names):
+    """
+    Creates independent random streams from a single seed, by spawning
+    a child SeedSequence for each stream.
+
+    Args:
+        seed (int): The seed, None to seed from the operating system.
+        names (list): Name of each stream.
+
+    Returns:
+        A dictionary with a RandomStream for each name.
+    """
+    children = np.random.SeedSequence(seed).spawn(len(names))
+    return {name: RandomStream(child) for name, child in zip(names, children)}
@@ -0,0 +1,477 @@
+""" Module for the columnar data collector of the road model.
+Replaces the mesa DataCollector, which appends every reported value to a
+python list and reports run constants on every step.
+"""
+import numpy as np
+import pandas as pd
+
+
+class RunningStats:
+    """
+    Mean and variance of a stream of values, updated with Welford's
+    algorithm so no values have to be stored. Nan values are ignored.
+
+    Attributes:
+        count (int): Number of values seen.
+        mean (float): Mean of the values.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = np.nan
+        self._m2 = 0.0
+
+    def update(self, value):
+        """
+        Adds a value to the statistics.
+        """
+        if value != value:
+            return
+        self.count += 1
+        if self.count == 1:
+            self.mean = float(value)
+            return
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self):
+        """ The population variance of the values, as np.var computes. """
+        if not self.count:
+            return np.nan
+        return self._m2 / self.count
+
+
+class P2Quantile:
+    """
+    Estimates a quantile of a stream of values with the P-square algorithm
+    of Jain and Chlamtac, which tracks five markers instead of storing the
+    values. Nan values are ignored.
+
+    Attributes:
+        p (float): The quantile to estimate, between 0 and 1.
+    """
+
+    def __init__(self, p):
+        """
+        Args:
+            p (float): The quantile to estimate, between 0 and 1.
+        """
+        self.p = p
+        self._heights = []
+        self._pos = [0, 1, 2, 3, 4]
+        self._desired = [0, 2*p, 4*p, 2+2*p, 4]
+        self._increments = [0, p/2, p, (1+p)/2, 1]
+
+    def update(self, value):
+        """
+        Adds a value to the estimate.
+        """
+        if value != value:
+            return
+        q = self._heights
+        if len(q) < 5:
+            q.append(float(value))
+            q.sort()
+            return
+
+        if value < q[0]:
+            q[0] = value
+            k = 0
+        elif value >= q[4]:
+            q[4] = value
+            k = 3
+        else:
+            k = 0
+            while value >= q[k+1]:
+                k += 1
+        n = self._pos
+        for i in range(k+1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        for i in range(1, 4):
+            d = self._desired[i] - n[i]
+            if (d >= 1 and n[i+1] - n[i] > 1) or\
+                    (d <= -1 and n[i-1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = q[i] + d / (n[i+1] - n[i-1]) * (
+                    (n[i] - n[i-1] + d) * (q[i+1] - q[i]) / (n[i+1] - n[i]) +
+                    (n[i+1] - n[i] - d) * (q[i] - q[i-1]) / (n[i] - n[i-1]))
+                if not q[i-1] < height < q[i+1]:
+                    height = q[i] + d * (q[i+d] - q[i]) / (n[i+d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    @property
+    def value(self):
+        """ The current estimate of the quantile. """
+        if len(self._heights) < 5:
+            if not self._heights:
+                return np.nan
+            return float(np.percentile(self._heights, 100*self.p))
+        return self._heights[2]
+
+
+class ConvergenceMonitor:
+    """
+    Detects when the collected values of a run have reached a steady state,
+    with the method of batch means. The values are averaged in batches of
+    batch_size collections. The initial transient is removed with the MSER
+    rule, which truncates the batches before the point that minimizes the
+    standard error of the remaining batches. The run has converged once the
+    confidence interval of the mean of the remaining batches is within a
+    fraction rel_width of the mean, for every monitored column.
+
+    Attributes:
+        names (tuple): The monitored columns.
+        rel_width (float): Target half width of the confidence interval,
+            relative to the mean.
+        batch_size (int): Number of collected values per batch.
+        min_batches (int): Minimal number of batches after truncation.
+        z (float): Normal quantile of the confidence level.
+        batches (dict): The batch means of each column.
+        truncation (int): Number of batches removed as transient at the
+            last check.
+        stop_step (int): Model step at which the run converged, the step
+            count of the schedule when it stops, None before.
+    """
+
+    def __init__(self, names=('Avg_speed', 'Cars_in_lane'), rel_width=0.01,
+                 batch_size=50, min_batches=20, z=1.96):
+        """
+        Args:
+            names (tuple): The columns to monitor.
+            rel_width (float): Target half width of the confidence
+                interval, relative to the mean.
+            batch_size (int): Number of collected values per batch.
+            min_batches (int): Minimal number of batches after truncation.
+            z (float): Normal quantile of the confidence level, 1.96 for a
+                95% interval.
+        """
+        self.names = tuple(names)
+        self.rel_width = rel_width
+        self.batch_size = batch_size
+        self.min_batches = min_batches
+        self.z = z
+        self.batches = {name: [] for name in self.names}
+        self.truncation = 0
+        self.stop_step = None
+        self._sums = {name: 0.0 for name in self.names}
+        self._count = 0
+
+    def update(self, step, values):
+        """
+        Adds the collected values of a step, and checks for convergence
+        each time a batch is complete.
+
+        Args:
+            step (int): The model step at which the values were collected,
+                the schedule step count after the step.
+            values (dict): The collected value of each column.
+
+        Returns:
+            True if the run has converged.
+        """
+        if self.stop_step is not None:
+            return True
+        for name in self.names:
+            self._sums[name] += values[name]
+        self._count += 1
+        if self._count < self.batch_size:
+            return False
+
+        for name in self.names:
+            self.batches[name].append(self._sums[name] / self._count)
+            self._sums[name] = 0.0
+        self._count = 0
+        if self.converged():
+            self.stop_step = step
+            return True
+        return False
+
+    @staticmethod
+    def mser(batches):
+        """
+        Determines the MSER truncation point of a series of batch means: the
+        number of leading batches, at most half of them, after which the
+        remaining batches have the lowest squared standard error.
+        """
+        batches = np.asarray(batches, dtype=float)
+        n = len(batches)
+        sums = np.cumsum(batches[::-1])[::-1]
+        squares = np.cumsum(batches[::-1]**2)[::-1]
+        remaining = n - np.arange(n//2 + 1)
+        sums, squares = sums[:n//2 + 1], squares[:n//2 + 1]
+        errors = (squares - sums**2/remaining) / remaining**2
+        return int(np.argmin(errors))
+
+    def interval(self, name):
+        """
+        Returns the steady state mean of a column and the half width of its
+        confidence interval, after removing the transient batches.
+        """
+        batches = np.asarray(self.batches[name][self.truncation:])
+        if len(batches) < 2:
+            return np.nan, np.nan
+        half_width = self.z * batches.std(ddof=1) / np.sqrt(len(batches))
+        return batches.mean(), half_width
+
+    def converged(self):
+        """
+        Determines the truncation point and checks whether the confidence
+        interval of every column is narrow enough.
+        """
+        n = len(self.batches[self.names[0]])
+        if n < self.min_batches:
+            return False
+        self.truncation = max(self.mser(self.batches[name])
+                              for name in self.names)
+        if n - self.truncation < self.min_batches:
+            return False
+        for name in self.names:
+            mean, half_width = self.interval(name)
+            if not half_width <= self.rel_width * abs(mean):
+                return False
+        return True
+
+    def summary(self):
+        """
+        Returns the steady state estimates: the mean and half width of each
+        column, named e.g. Avg_speed_ss_mean and Avg_speed_ss_width, the
+        number of collected values removed as transient and the stopping
+        step, which is None if the run did not converge.
+        """
+        summary = {'stop_step': self.stop_step,
+                   'truncated': self.truncation * self.batch_size}
+        for name in self.names:
+            mean, half_width = self.interval(name)
+            summary[name + '_ss_mean'] = mean
+            summary[name + '_ss_width'] = half_width
+        return summary
+
+
+class RoadCollector:
+    """
+    Collects the model level data of a RoadSim run in preallocated numpy
+    columns, which grow by a fixed number of rows when full. The speed
+    aggregates are computed from the speed arrays of the model in a single
+    pass, and values which are constant during a run are stored once.
+
+    Provides get_model_vars_dataframe and model_vars like the mesa
+    DataCollector, so it can be used by the mesa ChartModule and the
+    analysis scripts.
+
+    Data is collected every stride steps. Besides the columns the collector
+    keeps running statistics of every collected value after the warm-up
+    steps: the mean, variance and a number of quantiles. With keep_series
+    disabled only these statistics are kept, so the memory of a run does
+    not grow with the number of steps. An optional ConvergenceMonitor is
+    given the collected values after the warm-up.
+
+    Attributes:
+        chunk_size (int): Number of rows added to the columns when full.
+        columns (dict): The numpy buffer of each collected column.
+        params (tuple): The (spawn, agression, lanes) parameters of the run.
+        run (int): The uid of the run.
+        stride (int): Number of steps between collections.
+        warmup (int): Number of steps excluded from the statistics.
+        keep_series (bool): Store the collected values in the columns.
+        steps (int): Number of steps seen by the collector.
+        stats (dict): The RunningStats of each column.
+        quantiles (dict): The P2Quantile estimates of the average speed and
+            the cars per lane.
+        last (dict): The last collected value of each column.
+        monitor (obj): The ConvergenceMonitor of the run, or None.
+    """
+    dtypes = {'Avg_speed': float,
+              'Cars_in_lane': int,
+              'Avg_slowdown': float}
+    tracked_quantiles = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+    def __init__(self, model, chunk_size=1024, stride=1, warmup=0,
+                 keep_series=True, monitor=None):
+        """
+        Args:
+            model (obj): The RoadSim instance to collect from.
+            chunk_size (int): Number of rows added to the columns when full.
+            stride (int): Number of steps between collections.
+            warmup (int): Number of steps excluded from the statistics.
+            keep_series (bool): Store the collected values in the columns,
+                otherwise only the statistics are kept.
+            monitor (obj): A ConvergenceMonitor, or None.
+        """
+        self.chunk_size = chunk_size
+        self.stride = stride
+        self.warmup = warmup
+        self.keep_series = keep_series
+        rows = chunk_size if keep_series else 0
+        self.columns = {name: np.empty(rows, dtype=dtype)
+                        for name, dtype in self.dtypes.items()}
+        self.params = (model.spawn_chance, model.agression, model.lanes)
+        self.run = model.uid
+        self.steps = 0
+        self.stats = {name: RunningStats() for name in self.dtypes}
+        self.quantiles = {name: [P2Quantile(p)
+                                 for p in self.tracked_quantiles]
+                          for name in ('Avg_speed', 'Cars_in_lane')}
+        self.last = {name: np.nan for name in self.dtypes}
+        self.monitor = monitor
+        self._rows = 0
+
+    def __len__(self):
+        return self._rows
+
+    def _grow(self):
+        """
+        Private method which adds chunk_size rows to every column.
+        """
+        for name, column in self.columns.items():
+            new_column = np.empty(len(column) + self.chunk_size,
+                                  dtype=column.dtype)
+            new_column[:self._rows] = column[:self._rows]
+            self.columns[name] = new_column
+
+    def collect(self, model):
+        """
+        Collects the data of the current step of the model.
+
+        Args:
+            model (obj): The RoadSim instance to collect from.
+        """
+        if self.steps % self.stride:
+            self.steps += 1
+            return
+        speeds, max_speeds = model.get_speeds()
+        self.collect_totals(len(speeds), np.sum(speeds), np.sum(max_speeds),
+                            model.lanes)
+
+    def collect_totals(self, count, speed_sum, max_speed_sum, lanes):
+        """
+        Collects the data of the current step from the totals of the cars,
+        for models which do not hold all speeds in one process.
+
+        Args:
+            count (int): Number of cars on the road.
+            speed_sum (float): Sum of the speeds of the cars in m/s.
+            max_speed_sum (float): Sum of the maximum speeds in m/s.
+            lanes (int): Number of lanes of the road.
+        """
+        step = self.steps
+        self.steps += 1
+        if step % self.stride:
+            return
+        with np.errstate(all='ignore'):
+            speed = np.divide(speed_sum, count) * 3.6
+            slowdown = np.divide(max_speed_sum, count) * 3.6 - speed
+        self.record(step, {'Avg_speed': speed,
+                           'Cars_in_lane': count // lanes,
+                           'Avg_slowdown': slowdown})
+
+    def record(self, step, values):
+        """
+        Stores the collected values of a step and updates the statistics,
+        also used to replay the stored series of a run with other warm-up
+        settings.
+
+        Args:
+            step (int): Number of steps seen by the collector before the
+                values were collected.
+            values (dict): The value of each column.
+        """
+        self.last = values
+
+        if self.keep_series:
+            if self._rows == len(self.columns['Avg_speed']):
+                self._grow()
+            for name, value in values.items():
+                self.columns[name][self._rows] = value
+            self._rows += 1
+
+        if step >= self.warmup:
+            for name, value in values.items():
+                self.stats[name].update(value)
+            for name, quantiles in self.quantiles.items():
+                for quantile in quantiles:
+                    quantile.update(values[name])
+            if self.monitor is not None:
+                # The model has completed its step + 1-th step
+                self.monitor.update(step + 1, values)
+
+    def summary(self):
+        """
+        Returns the statistics of the collected values after the warm-up.
+
+        Returns:
+            A dictionary with the mean and variance of each column, named
+            e.g. Avg_speed_mean and Avg_speed_var, the quantiles of the
+            average speed and cars per lane, named e.g. Avg_speed_q50, and
+            the number of values the statistics are based on. The last
+            collected value of each column is named e.g. Avg_speed_last.
+            With a monitor its steady state estimates are included.
+        """
+        summary = {'samples': self.stats['Avg_speed'].count}
+        for name, stats in self.stats.items():
+            summary[name + '_mean'] = stats.mean
+            summary[name + '_var'] = stats.variance
+            summary[name + '_last'] = self.last[name]
+        for name, quantiles in self.quantiles.items():
+            for quantile in quantiles:
+                summary[f'{name}_q{int(round(100*quantile.p)):02d}'] = \
+                    quantile.value
+        if self.monitor is not None:
+            summary.update(self.monitor.summary())
+        return summary
+
+    @property
+    def model_vars(self):
+        """
+        The collected values of each column as lists, as the mesa
+        DataCollector provides them.
+        """
+        return {name: column[:self._rows].tolist()
+                for name, column in self.columns.items()}
+
+    def get_column(self, name):
+        """
+        Returns the collected values of a single column as an array.
+        """
+        return self.columns[name][:self._rows]
+
+    def get_model_vars_dataframe(self):
+        """
+        Creates a DataFrame with a row for each collected step, with the
+        same columns as the mesa DataCollector of the model had.
+        """
+        data = pd.DataFrame({name: self.get_column(name)
+                             for name in self.columns})
+        data['Model Params'] = pd.Series([self.params]*self._rows,
+                                         dtype=object)
+        data['Run'] = self.run
+        return data
+
+    def to_records(self):
+        """
+        Returns the collected columns as a single numpy record array, with
+        a field for each column.
+        """
+        records = np.empty(self._rows, dtype=[(name, column.dtype)
+                                              for name, column
+                                              in self.columns.items()])
+        for name in self.columns:
+            records[name] = self.get_column(name)
+        return records
+
+    def to_arrow(self):
+        """
+        Creates a pyarrow Table of the collected columns, with the run
+        parameters stored once in the schema metadata. Requires pyarrow.
+        """
+        import pyarrow as pa
+        table = pa.table({name: self.get_column(name)
+                          for name in self.columns})
+        return table.replace_schema_metadata(
+            {'spawn': str(self.params[0]), 'agression': str(self.params[1]),
+             'lanes': str(self.params[2]), 'run': str(self.run)})
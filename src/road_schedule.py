@@ -0,0 +1,114 @@
+""" Module for the scheduler of the car agents.
+Replaces the mesa RandomActivation scheduler with one tailored to a road
+on which many cars enter and leave every step.
+"""
+import numpy as np
+
+
+class RoadSchedule:
+    """
+    Activates each car agent once per step. The agents are stored in a
+    contiguous numpy object array, with a dictionary from unique_id to the
+    index of each agent. Removing an agent moves the last agent into its
+    place, so adding and removing agents are O(1) operations and the
+    activation order is a single permutation of the array.
+
+    Provides the parts of the mesa scheduler interface used by the model
+    and the mesa visualization and data collection modules.
+
+    Attributes:
+        model (obj): The model instance of the scheduler.
+        order (str): Order in which the agents are activated each step:
+            'random', 'front' to start with the car furthest along the road,
+            or 'back' to start with the car closest to the start.
+        steps (int): Number of steps taken.
+        time (float): Simulated time, advances by one each step.
+    """
+    orders = ('random', 'front', 'back')
+
+    def __init__(self, model, order='random'):
+        """
+        Args:
+            model (obj): The model instance of the scheduler.
+            order (str): The activation order, one of 'random', 'front'
+                or 'back'.
+        """
+        if order not in self.orders:
+            raise ValueError(f"unknown activation order '{order}'")
+        self.model = model
+        self.order = order
+        self.steps = 0
+        self.time = 0
+        self._agents = np.empty(16, dtype=object)
+        self._count = 0
+        self._index = {}
+
+    def add(self, agent):
+        """
+        Adds an agent to the schedule, doubles the capacity of the agent
+        array if it is full.
+
+        Args:
+            agent (obj): An agent with a unique_id and step method.
+        """
+        if agent.unique_id in self._index:
+            raise ValueError(f"agent with unique id {agent.unique_id} "
+                             "already added to scheduler")
+        if self._count == len(self._agents):
+            new_agents = np.empty(2*len(self._agents), dtype=object)
+            new_agents[:self._count] = self._agents
+            self._agents = new_agents
+        self._agents[self._count] = agent
+        self._index[agent.unique_id] = self._count
+        self._count += 1
+
+    def remove(self, agent):
+        """
+        Removes an agent from the schedule by moving the last agent
+        into its place.
+
+        Args:
+            agent (obj): An agent which was previously added.
+        """
+        i = self._index.pop(agent.unique_id)
+        self._count -= 1
+        last = self._agents[self._count]
+        if last is not agent:
+            self._agents[i] = last
+            self._index[last.unique_id] = i
+        self._agents[self._count] = None
+
+    @property
+    def agents(self):
+        """ A list of all agents in the schedule. """
+        return list(self._agents[:self._count])
+
+    def get_agent_count(self):
+        """ Returns the number of agents in the schedule. """
+        return self._count
+
+    def activation_order(self):
+        """
+        Determines the order in which the agents are activated this step.
+
+        Returns:
+            An object array with all agents in order of activation.
+        """
+        agents = self._agents[:self._count]
+        if self.order == 'random':
+            return agents[self.model.order_rng.permutation(self._count)]
+        locs = np.fromiter((agent.pos[0] for agent in agents),
+                           dtype=float, count=self._count)
+        if self.order == 'front':
+            locs = -locs
+        return agents[np.argsort(locs, kind='stable')]
+
+    def step(self):
+        """
+        Activates all agents once, agents removed during the step are not
+        affected as the order is determined beforehand.
+        """
+        for agent in self.activation_order():
+            agent.step()
+        self.steps += 1
+        self.time += 1
@@ -0,0 +1,220 @@
+""" Module for snapshots of the road model.
+Captures the complete state of a RoadSim as a binary snapshot, from which
+the run can be resumed exactly, or from which new runs can be forked, e.g.
+from a road which has already passed its warm-up.
+"""
+import os
+import pickle
+import numpy as np
+import cargrid as car
+from modelgrid import RoadSim
+from road_schedule import RoadSchedule
+
+"""
+Version of the snapshot layout, snapshots of another version are refused.
+"""
+SNAPSHOT_VERSION = 1
+
+"""
+Parameters which determine the layout of the road, and can not be changed
+when a snapshot is restored.
+"""
+ROAD_PARAMS = ('lanes', 'length', 'speed', 'time_step')
+
+"""
+The attributes of each car agent stored in a snapshot, the position is
+stored as its loc and lane.
+"""
+CAR_FIELDS = ('unique_id', 'loc', 'lane', 'start_lane', 'index',
+              'max_speed', 'speed', 'agression', 'gap', 'switch_delay',
+              'switched')
+
+"""
+The attributes of the LaneSpace stored in a snapshot.
+"""
+GRID_FIELDS = ('length', 'locs', 'lane_ids', 'lane_index', 'lane_slots',
+               'free_slots', 'zone_counts')
+
+
+def get_state(model):
+    """
+    Gathers the state of a model: the position and attributes of every car
+    in the order of the scheduler, the LaneSpace, the step counters, the
+    state of each random stream, the id counter and the data collector with
+    its convergence monitor. Profilers and trajectory recorders are not
+    part of the state.
+
+    Args:
+        model (obj): The RoadSim instance.
+
+    Returns:
+        A dictionary with the state, which shares its arrays with the model.
+    """
+    streams = {}
+    for name in ('spawn_rng', 'car_rng', 'order_rng'):
+        stream = getattr(model, name)
+        streams[name] = {'state': stream.generator.bit_generator.state,
+                         'uniform': stream._uniform,
+                         'normal': stream._normal}
+    collector = dict(vars(model.datacollector))
+    # Method wrappers of an attached profiler belong to the model instance
+    collector.pop('collect', None)
+    rows = len(model.datacollector)
+    collector['columns'] = {name: column[:rows] for name, column
+                            in collector['columns'].items()}
+
+    state = {'version': SNAPSHOT_VERSION,
+             'params': model.params,
+             'current_id': model.current_id,
+             'running': model.running,
+             'slowdown_loops': model.slowdown_loops,
+             'random': model.random.getstate(),
+             'streams': streams,
+             'steps': model.schedule.steps,
+             'time': model.schedule.time,
+             'collector': collector}
+    if model.road is not None:
+        state['cars'] = {name: getattr(model.road, name)
+                         for name in model.road.columns}
+        return state
+
+    agents = model.schedule.agents
+    cars = {name: np.array([getattr(agent, name) for agent in agents])
+            for name in CAR_FIELDS if name not in ('loc', 'lane')}
+    cars['loc'] = np.array([agent.pos[0] for agent in agents])
+    cars['lane'] = np.array([agent.pos[1] for agent in agents], dtype=int)
+    state['cars'] = cars
+    state['grid'] = {name: getattr(model.grid, name) for name in GRID_FIELDS}
+    return state
+
+
+def snapshot(model):
+    """
+    Creates a binary snapshot of a model, see get_state.
+
+    Args:
+        model (obj): The RoadSim instance.
+
+    Returns:
+        The snapshot as bytes.
+    """
+    return pickle.dumps(get_state(model), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def save_snapshot(model, path):
+    """
+    Writes a snapshot of a model to a file. The snapshot is written to a
+    temporary file first, so an interrupted checkpoint does not overwrite
+    the previous one.
+
+    Args:
+        model (obj): The RoadSim instance.
+        path (str): The file name of the snapshot.
+    """
+    temp = path + '.tmp'
+    with open(temp, 'wb') as snapshot_file:
+        snapshot_file.write(snapshot(model))
+    os.replace(temp, path)
+
+
+def load_snapshot(path, fork=False, **overrides):
+    """
+    Restores a model from a snapshot file, see restore.
+
+    Args:
+        path (str): The file name of the snapshot.
+        fork (bool): Fork a new run instead of resuming the run.
+        overrides: RoadSim arguments which replace those of the snapshot.
+
+    Returns:
+        The restored RoadSim instance.
+    """
+    with open(path, 'rb') as snapshot_file:
+        return restore(snapshot_file.read(), fork, **overrides)
+
+
+def restore(data, fork=False, **overrides):
+    """
+    Restores a model from a snapshot. A resumed run continues exactly as the
+    run from which the snapshot was taken.
+
+    A forked run starts from the cars on the road of the snapshot, but with
+    a new data collector, the step counter at zero and new random streams,
+    seeded from the seed argument. Give every fork a different seed, as
+    forks with the same seed make the same draws. The warm-up, max_steps
+    and convergence of a fork apply to the steps after the snapshot.
+
+    The arguments of the snapshot can be replaced, except the lanes, the
+    length, the speed and the time step of the road, and the engine can
+    only be changed between the vector and the kernel engine. Changes to
+    the agression and minimum gap only apply to new cars.
+
+    Args:
+        data (bytes): The snapshot, see snapshot.
+        fork (bool): Fork a new run instead of resuming the run.
+        overrides: RoadSim arguments which replace those of the snapshot.
+
+    Returns:
+        The restored RoadSim instance.
+    """
+    state = pickle.loads(data)
+    if state['version'] != SNAPSHOT_VERSION:
+        raise ValueError(f"unsupported snapshot version {state['version']}")
+    params = dict(state['params'], **overrides)
+    for name in ROAD_PARAMS:
+        if params[name] != state['params'][name]:
+            raise ValueError(f"the {name} of a snapshot can not be changed")
+    if (params['engine'] == 'agent') != (state['params']['engine'] == 'agent'):
+        raise ValueError("a snapshot can not be restored with the agent "
+                         "engine and a vector engine")
+
+    model = RoadSim(**params)
+    model.current_id = state['current_id']
+    model.slowdown_loops = state['slowdown_loops']
+    if model.road is not None:
+        for name, column in state['cars'].items():
+            setattr(model.road, name, column)
+    else:
+        _restore_agents(model, state)
+
+    if fork:
+        return model
+    model.running = state['running']
+    model.random.setstate(state['random'])
+    for name, stream_state in state['streams'].items():
+        stream = getattr(model, name)
+        stream.generator.bit_generator.state = stream_state['state']
+        stream._uniform = stream_state['uniform']
+        stream._normal = stream_state['normal']
+    model.schedule.steps = state['steps']
+    model.schedule.time = state['time']
+    # Update the collector in place, it may be wrapped by a profiler
+    vars(model.datacollector).update(state['collector'])
+    model.monitor = model.datacollector.monitor
+    return model
+
+
+def _restore_agents(model, state):
+    """
+    Private function which replaces the cars, grid and scheduler of a model
+    with the agent engine by those of a snapshot. The cars are added to the
+    scheduler in their original order, which determines the activation
+    order of the following steps.
+    """
+    grid = model.grid
+    for name in GRID_FIELDS:
+        setattr(grid, name, state['grid'][name])
+    model.schedule = RoadSchedule(model, model.schedule.order)
+    cars = state['cars']
+    # Python scalars, so the cars behave as if they were never stored
+    columns = [cars[name].tolist() for name in CAR_FIELDS]
+    for (uid, loc, lane, start_lane, index, max_speed, speed, agression,
+         gap, switch_delay, switched) in zip(*columns):
+        agent = car.Car(uid, model, start_lane, speed, agression,
+                        model.min_gap, max_speed=max_speed, gap=gap)
+        agent.pos = (loc, lane)
+        agent.index = index
+        agent.speed = speed
+        agent.switch_delay = switch_delay
+        agent.switched = switched
+        model.schedule.add(agent)
@@ -0,0 +1,548 @@
+""" Module for batch runs of the road model.
+Each run is performed in a worker process which writes the collected data
+of every step straight to its own file, and only returns a small manifest
+entry with the parameters, summary statistics and location of the file.
+The runs can be given as an OFAT grid or as a SALib sample matrix.
+Finished runs can be kept in a ResultStore, so an interrupted sweep can be
+resumed and overlapping sweeps share their runs.
+"""
+import os
+import json
+import hashlib
+import inspect
+from itertools import product
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from modelgrid import RoadSim
+from snapshot import load_snapshot
+
+"""
+Default values of the RoadSim parameters, used to estimate the cost of runs.
+"""
+MODEL_DEFAULTS = {name: par.default for name, par
+                  in inspect.signature(RoadSim).parameters.items()}
+
+"""
+The RoadSim parameters which determine the trajectory of a run, and with it
+the collected series. The warm-up and keep_series only affect what is kept
+of the series, so runs which differ in those share their stored results.
+"""
+TRAJECTORY_PARAMS = ('lanes', 'length', 'spawn', 'agression', 'speed',
+                     'time_step', 'min_gap', 'engine', 'slowdown', 'order',
+                     'seed', 'collect_stride')
+
+"""
+The source files which determine the results of a run.
+"""
+MODEL_SOURCES = ('modelgrid.py', 'cargrid.py', 'lane_grid.py',
+                 'vector_engine.py', 'kernels.py', 'road_schedule.py',
+                 'random_stream.py', 'road_collector.py', 'snapshot.py')
+
+
+def code_version():
+    """
+    Returns a hash of the model source files, which changes whenever the
+    model code changes.
+    """
+    digest = hashlib.sha1()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in MODEL_SOURCES:
+        with open(os.path.join(directory, name), 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+
+def run_key(params, max_steps, replicate=0, version=None, file_hashes=None):
+    """
+    Computes the key of a run in a ResultStore: a hash of the
+    TRAJECTORY_PARAMS, including their defaults, the number of steps, the
+    replicate and the code version. A convergence criterion and the warm-up
+    are included if the criterion is set, as it ends the run early. Runs
+    forked from a snapshot also include a hash of the contents of the
+    snapshot file, so rewriting the snapshot under the same name does not
+    return stale results.
+
+    Args:
+        params (dict): The RoadSim keyword arguments of the run.
+        max_steps (int): Number of steps of the run.
+        replicate (int): Number of earlier runs with the same parameters in
+            the sweep, distinguishes the replicates of unseeded runs.
+        version (str): The code version, see code_version.
+        file_hashes (dict): Cache of the hash of each snapshot file, so a
+            sweep reads every snapshot once, None to not cache the hashes.
+
+    Returns:
+        The key as a hexadecimal string.
+    """
+    params = dict(MODEL_DEFAULTS, **params)
+    content = {'params': {name: params[name] for name in TRAJECTORY_PARAMS},
+               'max_steps': max_steps,
+               'replicate': replicate,
+               'version': version or code_version()}
+    if params['convergence']:
+        # The monitor only starts after the warm-up, so both end the run
+        content['convergence'] = params['convergence']
+        content['warmup'] = int(params['warmup']*(params['max_steps'] or 0))
+    snapshot = params.get('snapshot')
+    if snapshot is not None:
+        if file_hashes is None:
+            file_hashes = {}
+        if snapshot not in file_hashes:
+            file_hashes[snapshot] = file_hash(snapshot)
+        content['snapshot'] = file_hashes[snapshot]
+    content = json.dumps(content, sort_keys=True, default=_to_builtin)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def file_hash(path):
+    """
+    Returns a hash of the contents of a file.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _to_builtin(value):
+    """
+    Private function which converts numpy scalars for the json encoder.
+    """
+    return value.item()
+
+
+class ResultStore:
+    """
+    Directory with the results of finished runs, keyed by run_key. Each
+    run has a json file with its manifest entry, and a file with its step
+    data if that is kept. Files are written to a temporary name first, so a
+    run which is interrupted while saving is not found in the store.
+
+    Attributes:
+        directory (str): The directory of the store.
+    """
+
+    def __init__(self, directory):
+        """
+        Args:
+            directory (str): The directory of the store, created if it
+                does not exist.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """
+        Returns the file name of a run without extension.
+        """
+        return os.path.join(self.directory, key)
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key) + '.json')
+
+    def load(self, key):
+        """
+        Returns the stored manifest entry of a run.
+        """
+        with open(self.path(key) + '.json') as entry_file:
+            return json.load(entry_file)
+
+    def save(self, key, entry):
+        """
+        Stores the manifest entry of a finished run.
+        """
+        temp_path = self.path(key) + '.json.tmp'
+        with open(temp_path, 'w') as entry_file:
+            json.dump(entry, entry_file, default=_to_builtin)
+        os.replace(temp_path, self.path(key) + '.json')
+
+
+def parameter_grid(variable_parameters, fixed_parameters=None,
+                   iterations=1):
+    """
+    Creates the parameters of all runs of an OFAT like batch run, in the
+    same way as the mesa batch runner: every combination of the variable
+    parameters, combined with the fixed parameters.
+
+    Args:
+        variable_parameters (dict): All values of each varied parameter.
+        fixed_parameters (dict): Parameters which are the same for all runs.
+        iterations (int): Number of runs of each combination.
+
+    Returns:
+        A list with a dictionary of model parameters for each run.
+    """
+    fixed_parameters = fixed_parameters or {}
+    names = list(variable_parameters)
+    runs = []
+    for values in product(*variable_parameters.values()):
+        params = dict(fixed_parameters)
+        params.update(zip(names, values))
+        runs.extend(dict(params) for _ in range(iterations))
+    return runs
+
+
+def sample_runs(problem, param_values, fixed_parameters=None,
+                replicates=1):
+    """
+    Creates the parameters of all runs for a SALib sample matrix, in the
+    order of SA.py: all samples of the first replicate, then all samples
+    of the second replicate and so on.
+
+    Args:
+        problem (dict): The SALib problem, of which the names are used.
+        param_values (array): The sample matrix, a row for each sample.
+        fixed_parameters (dict): Parameters which are the same for all runs.
+        replicates (int): Number of runs of each sample.
+
+    Returns:
+        A list with a dictionary of model parameters for each run.
+    """
+    fixed_parameters = fixed_parameters or {}
+    runs = []
+    for _ in range(replicates):
+        for values in param_values:
+            params = dict(fixed_parameters)
+            params.update(zip(problem['names'], np.asarray(values).tolist()))
+            runs.append(params)
+    return runs
+
+
+def estimate_cost(params, max_steps):
+    """
+    Estimates the relative duration of a run, proportional to the number of
+    cars that are stepped: the spawn chance times the number of lanes, the
+    length of the road and the number of steps.
+    """
+    params = dict(MODEL_DEFAULTS, **params)
+    return params['spawn'] * params['lanes'] * params['length'] * max_steps
+
+
+def save_run(collector, path, fmt='npy'):
+    """
+    Writes the collected data of a run to a file.
+
+    Args:
+        collector (obj): The RoadCollector of the run.
+        path (str): File name without extension.
+        fmt (str): 'npy' for a numpy record array, or 'parquet', which
+            requires pyarrow.
+
+    Returns:
+        The file name including the extension.
+    """
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        path += '.parquet'
+        pq.write_table(collector.to_arrow(), path)
+    elif fmt == 'npy':
+        path += '.npy'
+        np.save(path, collector.to_records())
+    else:
+        raise ValueError(f"unknown format '{fmt}'")
+    return path
+
+
+def load_run(path):
+    """
+    Reads the collected data of a run written by save_run.
+
+    Returns:
+        A dictionary with an array for each column.
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(path)
+        return {name: table[name].to_numpy() for name in table.column_names}
+    records = np.load(path)
+    return {name: records[name] for name in records.dtype.names}
+
+
+def run_single(task):
+    """
+    Performs a single run, to be called in a worker process. Saves the
+    collected data of the run if an output directory is given. Runs which
+    are stored always save their collected data, so the summary can be
+    recomputed for other warm-up settings, see summarize_run. If the
+    parameters contain a snapshot, the run is forked from the snapshot file
+    with the other parameters, see snapshot.restore. A fork without a seed
+    would make the same draws as the run of the snapshot, so it is seeded
+    from its store key, or else from its run_id, and every replicate
+    differs.
+
+    Args:
+        task (tuple): (run_id, params, max_steps, out_dir, fmt, store, key)
+            with the number of the run, the keyword arguments for RoadSim,
+            the number of steps, the output directory or None, the file
+            format, and the directory of the ResultStore and key of the run,
+            or None to not store the run.
+
+    Returns:
+        A manifest entry: a dictionary with the run_id, the parameters,
+        the number of steps, the summary statistics and the file name.
+    """
+    run_id, params, max_steps, out_dir, fmt, store, key = task
+    if params.get('snapshot') is not None and params.get('seed') is None:
+        seed = int(key[:8], 16) if key is not None else run_id
+        params = dict(params, seed=seed)
+    model_params = dict(params)
+    if store is not None:
+        model_params['keep_series'] = True
+    if params.get('snapshot') is not None:
+        model = load_snapshot(model_params.pop('snapshot'), fork=True,
+                              **model_params)
+    else:
+        model = RoadSim(**model_params)
+    while model.running and model.schedule.steps < max_steps:
+        model.step()
+
+    entry = {'run_id': run_id}
+    entry.update(params)
+    entry['steps'] = model.schedule.steps
+    entry['Run'] = model.uid
+    entry.update(model.datacollector.summary())
+    entry['path'] = None
+    path = None
+    if store is not None:
+        store = ResultStore(store)
+        path = store.path(key)
+    elif out_dir is not None:
+        path = os.path.join(out_dir, f'run_{run_id:06d}')
+    if path is not None and model.datacollector.keep_series:
+        entry['path'] = save_run(model.datacollector, path, fmt)
+    if store is not None:
+        entry['key'] = key
+        store.save(key, entry)
+    return entry
+
+
+def summarize_run(path, params):
+    """
+    Computes the summary statistics of a stored run for the warm-up and
+    convergence settings in params, by replaying its collected series
+    through the data collector of a new model with these settings.
+
+    Args:
+        path (str): The file with the collected data of the run.
+        params (dict): The RoadSim keyword arguments of the run.
+
+    Returns:
+        The summary of the run, see RoadCollector.summary.
+    """
+    params = {name: value for name, value in params.items()
+              if name != 'snapshot'}
+    collector = RoadSim(**dict(params, keep_series=False)).datacollector
+    series = load_run(path)
+    for row in range(len(series['Avg_speed'])):
+        collector.record(row*collector.stride,
+                         {name: series[name][row]
+                          for name in collector.dtypes})
+    return collector.summary()
+
+
+def stored_entry(entry, run_id, params):
+    """
+    Creates the manifest entry of a run loaded from a ResultStore. The run
+    may have been stored by a sweep with other parameters which do not
+    affect the trajectory, so the parameters are replaced by those of this
+    sweep and the summary is recomputed, see summarize_run.
+
+    Args:
+        entry (dict): The stored manifest entry.
+        run_id (int): The number of the run in this sweep.
+        params (dict): The RoadSim keyword arguments of the run.
+
+    Returns:
+        The manifest entry, as run_single returns it.
+    """
+    new_entry = {'run_id': run_id}
+    new_entry.update(params)
+    if new_entry.get('seed') is None:
+        # The seed a fork was given from its key
+        new_entry['seed'] = entry.get('seed')
+    new_entry['steps'] = entry['steps']
+    new_entry['Run'] = entry['Run']
+    new_entry.update(summarize_run(entry['path'], params))
+    new_entry['path'] = entry['path']
+    new_entry['key'] = entry['key']
+    return new_entry
+
+
+class BatchRun:
+    """
+    Runs the road model for a list of parameter sets over a pool of worker
+    processes. The step data of each run is written to a file in out_dir
+    by the worker, so only the manifest entries are sent back to the
+    parent process.
+
+    The runs are handed to the workers in chunks, starting with the runs
+    which are expected to take longest, so no worker is left with a long
+    run at the end of the sweep. The manifest is in the order of the runs.
+
+    With a store each finished run is saved in the ResultStore by its
+    worker, and runs which are already in the store are not performed
+    again. The step data of stored runs is kept in the store directory,
+    and the summaries of loaded runs are recomputed from it for the
+    warm-up of this sweep.
+
+    Attributes:
+        runs (list): The RoadSim keyword arguments of each run.
+        max_steps (int): Number of steps of each run.
+        out_dir (str): Directory for the step data, None to only keep the
+            summary statistics.
+        nr_processes (int): Number of worker processes, None to use all
+            cores.
+        fmt (str): File format of the step data, 'npy' or 'parquet'.
+        chunksize (int): Number of runs handed to a worker at once, None
+            for about four chunks per worker.
+        progress (bool): Show a progress bar.
+        store (obj): The ResultStore of finished runs, or None.
+        manifest (DataFrame): A row for each finished run.
+    """
+
+    def __init__(self, runs, max_steps=1000, out_dir='batch_run',
+                 nr_processes=None, fmt='npy', chunksize=None,
+                 progress=True, store=None):
+        """
+        Args:
+            runs (list): The RoadSim keyword arguments of each run, see
+                parameter_grid.
+            max_steps (int): Number of steps of each run.
+            out_dir (str): Directory for the step data, None to only keep
+                the summary statistics.
+            nr_processes (int): Number of worker processes, None to use
+                all cores.
+            fmt (str): File format of the step data, 'npy' or 'parquet'.
+            chunksize (int): Number of runs handed to a worker at once.
+            progress (bool): Show a progress bar.
+            store (str): Directory of the ResultStore to keep the finished
+                runs in, None to not store the runs.
+        """
+        self.runs = runs
+        self.max_steps = max_steps
+        self.out_dir = out_dir
+        self.nr_processes = nr_processes
+        self.fmt = fmt
+        self.chunksize = chunksize
+        self.progress = progress
+        self.store = ResultStore(store) if store is not None else None
+        self.manifest = None
+
+    def keys(self):
+        """
+        Returns the ResultStore key of each run. Runs with the same
+        parameters are numbered as replicates, so the n-th replicate of a
+        configuration has the same key in every sweep.
+        """
+        version = code_version()
+        file_hashes = {}
+        replicates = {}
+        keys = []
+        for params in self.runs:
+            key = run_key(params, self.max_steps, version=version,
+                          file_hashes=file_hashes)
+            replicate = replicates.get(key, 0)
+            replicates[key] = replicate + 1
+            keys.append(run_key(params, self.max_steps, replicate, version,
+                                file_hashes))
+        return keys
+
+    def tasks(self, keys=None):
+        """
+        Returns the task tuples of all runs, see run_single, ordered from
+        the longest to the shortest expected duration. Runs which are in
+        the store are left out.
+
+        Args:
+            keys (list): The store key of each run, see keys.
+        """
+        store = self.store.directory if self.store is not None else None
+        keys = keys or [None]*len(self.runs)
+        tasks = [(run_id, params, self.max_steps, self.out_dir, self.fmt,
+                  store, key)
+                 for run_id, (params, key) in enumerate(zip(self.runs, keys))
+                 if store is None or key not in self.store]
+        return sorted(tasks, key=lambda task:
+                      -estimate_cost(task[1], self.max_steps))
+
+    def run_all(self):
+        """
+        Performs all runs which are not in the store and writes the
+        manifest to the output directory.
+
+        Returns:
+            The manifest as a DataFrame, with a row for each run.
+        """
+        if self.out_dir is not None:
+            os.makedirs(self.out_dir, exist_ok=True)
+        keys = self.keys() if self.store is not None else None
+        tasks = self.tasks(keys)
+        entries = []
+        if tasks:
+            processes = self.nr_processes or os.cpu_count()
+            chunksize = self.chunksize or max(1, len(tasks) // (4*processes))
+            with Pool(processes) as pool:
+                entries = list(tqdm(pool.imap_unordered(run_single, tasks,
+                                                        chunksize),
+                                    total=len(tasks),
+                                    disable=not self.progress))
+        if self.store is not None:
+            done = {entry['run_id'] for entry in entries}
+            for run_id, key in enumerate(keys):
+                if run_id not in done:
+                    entries.append(stored_entry(self.store.load(key),
+                                                run_id, self.runs[run_id]))
+        entries.sort(key=lambda entry: entry['run_id'])
+        self.manifest = pd.DataFrame(entries)
+        if self.out_dir is not None:
+            self.manifest.to_csv(os.path.join(self.out_dir, 'manifest.csv'),
+                                 index=False)
+        return self.manifest
+
+    def load_steps(self, params=None):
+        """
+        Reads the step data of all runs into a single DataFrame.
+
+        Args:
+            params (list): The parameters to add as columns, defaults to all
+                parameters of the runs.
+
+        Returns:
+            A DataFrame with a row for each collected step of each run, with
+            the run_id, Run uid and parameters of its run.
+        """
+        return load_steps(self.manifest, params)
+
+
+def load_steps(manifest, params=None):
+    """
+    Reads the step data of all runs in a manifest into a single DataFrame.
+    The columns of all runs are concatenated once, instead of appending
+    the runs one by one.
+
+    Args:
+        manifest (DataFrame): The manifest of a batch run, or the file name
+            of a stored manifest.
+        params (list): The parameters to add as columns, defaults to all
+            columns of the manifest up to the number of steps.
+
+    Returns:
+        A DataFrame with a row for each collected step of each run.
+    """
+    if isinstance(manifest, str):
+        manifest = pd.read_csv(manifest)
+    if params is None:
+        columns = list(manifest.columns)
+        params = columns[1:columns.index('steps')]
+    manifest = manifest[manifest['path'].notna()]
+
+    runs = [load_run(path) for path in manifest['path']]
+    lengths = [len(next(iter(run.values()))) for run in runs]
+    data = {name: np.concatenate([run[name] for run in runs])
+            for name in runs[0]} if runs else {}
+    for name in ['run_id', 'Run'] + list(params):
+        data[name] = np.repeat(manifest[name].to_numpy(), lengths)
+    return pd.DataFrame(data)
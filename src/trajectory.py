@@ -0,0 +1,195 @@
+""" Module for recording the trajectories of the cars.
+Streams the state of every car at every recorded step to disk in fixed
+size binary segments, so the memory of a recording does not grow with the
+length of the run.
+"""
+import os
+import json
+import numpy as np
+
+"""
+The fields of a trajectory record. Positions and speeds are stored in
+single precision, which is exact to well below a centimeter on a road of
+tens of kilometers.
+"""
+RECORD_DTYPE = np.dtype([('step', np.int32), ('uid', np.int64),
+                         ('lane', np.int16), ('loc', np.float32),
+                         ('speed', np.float32)])
+
+
+class TrajectoryRecorder:
+    """
+    Records the unique id, lane, position and speed of every car of a
+    RoadSim every stride steps. Records are gathered in a buffer of
+    chunk_rows rows, and each full buffer is written as a segment: a .npy
+    file which can be memory mapped, or a row group of a compressed Parquet
+    file, which requires pyarrow. The directory also gets a meta.json with
+    the road and recording settings.
+
+    The recorder attaches itself to the model, which records every step
+    after the data collection. Use close, or the recorder as a context
+    manager, to write the last partial segment.
+
+    Attributes:
+        directory (str): The directory of the recording.
+        stride (int): Number of steps between recordings.
+        chunk_rows (int): Number of records per segment.
+        fmt (str): 'npy' for .npy segments or 'parquet' for row groups.
+        segments (int): Number of segments written.
+        rows (int): Number of records written.
+    """
+
+    def __init__(self, model, directory, stride=1, chunk_rows=2**20,
+                 fmt='npy'):
+        """
+        Args:
+            model (obj): The RoadSim instance to record.
+            directory (str): Directory to write the recording to, created if
+                it does not exist.
+            stride (int): Number of steps between recordings.
+            chunk_rows (int): Number of records per segment, determines the
+                memory of the recorder.
+            fmt (str): 'npy' for memory mappable .npy segments, or 'parquet'
+                for a zstd compressed Parquet file with a row group per
+                segment.
+        """
+        if fmt not in ('npy', 'parquet'):
+            raise ValueError(f"unknown format '{fmt}'")
+        if fmt == 'parquet':
+            # Fail before the run instead of at the first full segment
+            import pyarrow.parquet  # noqa: F401
+        self.directory = directory
+        self.stride = stride
+        self.chunk_rows = chunk_rows
+        self.fmt = fmt
+        self.segments = 0
+        self.rows = 0
+        self._buffer = np.empty(chunk_rows, dtype=RECORD_DTYPE)
+        self._filled = 0
+        self._writer = None
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'meta.json'), 'w') as meta_file:
+            json.dump({'lanes': model.lanes, 'length': model.length,
+                       'time_step': model.time_step, 'stride': stride,
+                       'fmt': fmt}, meta_file)
+        model.recorder = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, model):
+        """
+        Records the cars of the current step if it is a multiple of the
+        stride. Called by RoadSim.step.
+
+        Args:
+            model (obj): The RoadSim instance to record.
+        """
+        step = model.schedule.steps
+        if step % self.stride:
+            return
+        uid, lane, loc, speed = model.get_cars()
+        start = 0
+        while start < len(uid):
+            size = min(len(uid) - start, self.chunk_rows - self._filled)
+            rows = self._buffer[self._filled:self._filled + size]
+            rows['step'] = step
+            rows['uid'] = uid[start:start + size]
+            rows['lane'] = lane[start:start + size]
+            rows['loc'] = loc[start:start + size]
+            rows['speed'] = speed[start:start + size]
+            self._filled += size
+            start += size
+            if self._filled == self.chunk_rows:
+                self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered records as a new segment.
+        """
+        if not self._filled:
+            return
+        records = self._buffer[:self._filled]
+        if self.fmt == 'npy':
+            np.save(os.path.join(self.directory,
+                                 f'segment_{self.segments:05d}.npy'),
+                    records)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.table({name: records[name]
+                              for name in RECORD_DTYPE.names})
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(
+                    os.path.join(self.directory, 'trajectory.parquet'),
+                    table.schema, compression='zstd')
+            self._writer.write_table(table)
+        self.segments += 1
+        self.rows += self._filled
+        self._filled = 0
+
+    def close(self):
+        """
+        Writes the remaining records and closes the Parquet file.
+        """
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def iter_segments(directory):
+    """
+    Iterates over the segments of a recording, so a recording can be
+    processed without loading it at once. The .npy segments are memory
+    mapped.
+
+    Args:
+        directory (str): The directory of the recording.
+
+    Yields:
+        A numpy record array with RECORD_DTYPE for each segment.
+    """
+    with open(os.path.join(directory, 'meta.json')) as meta_file:
+        fmt = json.load(meta_file)['fmt']
+    if fmt == 'npy':
+        names = sorted(name for name in os.listdir(directory)
+                       if name.startswith('segment_'))
+        for name in names:
+            yield np.load(os.path.join(directory, name), mmap_mode='r')
+        return
+
+    import pyarrow.parquet as pq
+    parquet = pq.ParquetFile(os.path.join(directory, 'trajectory.parquet'))
+    for group in range(parquet.num_row_groups):
+        table = parquet.read_row_group(group)
+        records = np.empty(table.num_rows, dtype=RECORD_DTYPE)
+        for name in RECORD_DTYPE.names:
+            records[name] = table[name].to_numpy()
+        yield records
+
+
+def load_trajectory(directory, steps=None):
+    """
+    Loads a recording, or the records of a range of steps, as a single
+    record array.
+
+    Args:
+        directory (str): The directory of the recording.
+        steps (tuple): (first, last) step to load, None for all steps.
+
+    Returns:
+        A numpy record array with RECORD_DTYPE.
+    """
+    parts = []
+    for segment in iter_segments(directory):
+        if steps is not None:
+            segment = segment[(segment['step'] >= steps[0]) &
+                              (segment['step'] <= steps[1])]
+        parts.append(np.asarray(segment))
+    if not parts:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    return np.concatenate(parts)
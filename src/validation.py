@@ -0,0 +1,182 @@
+"""
+Module to validate the vectorized engine against the agent based engine,
+and the partitioned road against the vectorized engine. Runs replicates of
+both with the same parameters and compares the average speed and the
+distribution of cars over the lanes after the warm-up period.
+"""
+import numpy as np
+from modelgrid import RoadSim
+from partition import PartitionedRoad
+
+
+def ks_statistic(a, b):
+    """
+    Two sample Kolmogorov-Smirnov statistic, the largest distance between
+    the empirical distribution functions of both samples.
+    """
+    a = np.sort(a)
+    b = np.sort(b)
+    values = np.concatenate((a, b))
+    cdf_a = np.searchsorted(a, values, side='right') / len(a)
+    cdf_b = np.searchsorted(b, values, side='right') / len(b)
+    return np.max(np.abs(cdf_a - cdf_b))
+
+
+def sample_engine(engine, params, steps, replicates, warmup):
+    """
+    Runs replicates of a model and records the average speed and the
+    number of cars in each lane at every step after the warm-up. The
+    replicates are seeded with their number.
+
+    Returns:
+        speeds (array): Average speed of each step in km/h.
+        lane_counts ((steps, lanes) array): Cars per lane of each step.
+    """
+    speeds = []
+    lane_counts = []
+    for seed in range(replicates):
+        model = RoadSim(engine=engine, seed=seed, **params)
+        for step in range(steps):
+            model.step()
+            if step >= warmup*steps:
+                speed, _ = model.get_speeds()
+                speeds.append(np.average(speed)*3.6)
+                lane_counts.append(model.get_lane_counts())
+    return np.array(speeds), np.array(lane_counts)
+
+
+def sample_partitioned(params, segments, steps, replicates, warmup):
+    """
+    Version of sample_engine for a PartitionedRoad with the given number of
+    segments.
+    """
+    speeds = []
+    lane_counts = []
+    for seed in range(replicates):
+        with PartitionedRoad(segments=segments, seed=seed, **params) as road:
+            for step in range(steps):
+                road.step()
+                if step >= warmup*steps:
+                    speeds.append(road.datacollector.last['Avg_speed'])
+                    lane_counts.append(road.get_lane_counts())
+    return np.array(speeds), np.array(lane_counts)
+
+
+def compare_engines(params, steps=3000, replicates=3, warmup=0.2,
+                    tolerance=0.1):
+    """
+    Compares the agent and vector engines for a set of model parameters.
+    The engines are considered equivalent if the mean average speed and
+    the mean number of cars in each lane differ by less than the relative
+    tolerance. The KS statistics are reported for inspection only, as the
+    steps of a run are strongly autocorrelated. Note that the vector engine
+    moves all cars at once, which shifts the lane distribution by a few
+    percent compared to cars moving one after another.
+
+    Args:
+        params (dict): Keyword arguments for RoadSim.
+        steps (int): Number of steps of each run.
+        replicates (int): Number of runs of each engine.
+        warmup (float): Fraction of the steps discarded as warm-up.
+        tolerance (float): Allowed relative difference of the means.
+
+    Returns:
+        A dictionary with the means, KS statistics and the verdict.
+    """
+    agent_speed, agent_lanes = sample_engine('agent', params, steps,
+                                             replicates, warmup)
+    vector_speed, vector_lanes = sample_engine('vector', params, steps,
+                                               replicates, warmup)
+    speed_diff = abs(np.mean(vector_speed) / np.mean(agent_speed) - 1)
+    lane_diff = np.abs(np.mean(vector_lanes, axis=0) /
+                       np.mean(agent_lanes, axis=0) - 1)
+    return {'agent_speed': np.mean(agent_speed),
+            'vector_speed': np.mean(vector_speed),
+            'speed_ks': ks_statistic(agent_speed, vector_speed),
+            'agent_lanes': np.mean(agent_lanes, axis=0),
+            'vector_lanes': np.mean(vector_lanes, axis=0),
+            'lanes_ks': [ks_statistic(agent_lanes[:, i], vector_lanes[:, i])
+                         for i in range(params.get('lanes', 3))],
+            'equivalent': speed_diff < tolerance and
+                          np.all(lane_diff < tolerance)}
+
+
+def compare_partitioned(params, segments=4, steps=3000, replicates=3,
+                        warmup=0.2, tolerance=0.05):
+    """
+    Compares a PartitionedRoad with the vector engine in a single process,
+    in the same way as compare_engines. Both decide on the positions at the
+    start of each step and see the same neighbours, so only the random
+    streams differ and the tolerance is tighter.
+
+    Args:
+        params (dict): Keyword arguments for RoadSim and PartitionedRoad.
+        segments (int): Number of segments of the partitioned road.
+        steps, replicates, warmup, tolerance: See compare_engines.
+
+    Returns:
+        A dictionary with the means, KS statistics and the verdict.
+    """
+    vector_speed, vector_lanes = sample_engine('vector', params, steps,
+                                               replicates, warmup)
+    part_speed, part_lanes = sample_partitioned(params, segments, steps,
+                                                replicates, warmup)
+    speed_diff = abs(np.mean(part_speed) / np.mean(vector_speed) - 1)
+    lane_diff = np.abs(np.mean(part_lanes, axis=0) /
+                       np.mean(vector_lanes, axis=0) - 1)
+    return {'vector_speed': np.mean(vector_speed),
+            'partitioned_speed': np.mean(part_speed),
+            'speed_ks': ks_statistic(vector_speed, part_speed),
+            'vector_lanes': np.mean(vector_lanes, axis=0),
+            'partitioned_lanes': np.mean(part_lanes, axis=0),
+            'lanes_ks': [ks_statistic(vector_lanes[:, i], part_lanes[:, i])
+                         for i in range(params.get('lanes', 3))],
+            'equivalent': speed_diff < tolerance and
+                          np.all(lane_diff < tolerance)}
+
+
+def check_lane_index(params, steps=1000):
+    """
+    Checks that the lane index of the LaneSpace stays consistent, i.e.
+    sorted and matching the positions of the slots, during a run with the
+    agent engine. Parameters with a small gap and a large time step let
+    speeds go negative, so cars also move backwards past the car behind.
+
+    Args:
+        params (dict): Keyword arguments for RoadSim.
+        steps (int): Number of steps of the run.
+
+    Returns:
+        The first step at which the index is inconsistent, or None.
+    """
+    model = RoadSim(engine='agent', **params)
+    grid = model.grid
+    for step in range(steps):
+        model.step()
+        for row, slots in zip(grid.lane_index, grid.lane_slots):
+            if row != sorted(row) or row != grid.locs[slots].tolist():
+                return step
+    return None
+
+
+if __name__ == '__main__':
+    reversing = [{'seed': 3, 'spawn': 0.9, 'length': 1500, 'lanes': 5,
+                  'agression': 0.5, 'min_gap': 0.1, 'time_step': 1.0},
+                 {'seed': 3, 'spawn': 0.9, 'length': 1500, 'lanes': 3,
+                  'agression': 0.05, 'min_gap': 0.1, 'time_step': 0.5}]
+    for scenario in reversing:
+        print(scenario, 'lane index broken at step',
+              check_lane_index(scenario))
+
+    scenarios = [{'lanes': 3, 'spawn': 0.4, 'agression': 0.5},
+                 {'lanes': 4, 'spawn': 0.8, 'agression': 0.3,
+                  'min_gap': 1.0}]
+    for scenario in scenarios:
+        result = compare_engines(scenario)
+        print(scenario)
+        for key, value in result.items():
+            print(f'    {key}: {value}')
+        result = compare_partitioned(dict(scenario, length=10000))
+        print(f'{scenario} partitioned')
+        for key, value in result.items():
+            print(f'    {key}: {value}')
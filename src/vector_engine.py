@@ -0,0 +1,303 @@
+""" Module for the vectorized road engine.
+Advances all cars on the road at once, storing the car state as
+struct-of-arrays instead of individual Car agents.
+"""
+import numpy as np
+import kernels
+
+
+class VectorEngine:
+    """
+    Alternative to stepping every Car agent through the mesa scheduler.
+    The state of all cars is kept in numpy columns, one element per car,
+    and every step the moves of all cars are decided with batched array
+    operations. The decision rules are the same as in Car.get_move, but
+    all cars decide on the positions at the start of the step instead of
+    one after another.
+
+    With the kernel option the moves are not decided with masks, but car by
+    car in the compiled loops of the kernels module, following Car.get_move
+    draw for draw. This is fastest for congested roads where cars go
+    through many slowdown iterations, provided numba is installed.
+
+    Attributes:
+        model (obj): The RoadSim instance hosting the engine.
+        kernel (bool): Use the compiled kernels to decide the moves.
+        uid (array): Unique id of each car.
+        loc (array): Horizontal position of each car.
+        lane (array): Current lane of each car.
+        speed (array): Current speed of each car.
+        max_speed (array): Maximum speed of each car.
+        agression (array): Agression of each car.
+        gap (array): Gap each car keeps relative to its speed.
+        switch_delay (array): Number of steps between lane switches.
+        switched (array): Steps remaining until a car may switch lanes.
+    """
+    columns = ('uid', 'loc', 'lane', 'speed', 'max_speed', 'agression',
+               'gap', 'switch_delay', 'switched')
+
+    def __init__(self, model, kernel=False):
+        """
+        Args:
+            model (obj): The RoadSim instance hosting the engine.
+            kernel (bool): Use the compiled kernels to decide the moves.
+        """
+        self.model = model
+        self.kernel = kernel
+        self.uid = np.empty(0, dtype=int)
+        self.loc = np.empty(0)
+        self.lane = np.empty(0, dtype=int)
+        self.speed = np.empty(0)
+        self.max_speed = np.empty(0)
+        self.agression = np.empty(0)
+        self.gap = np.empty(0)
+        self.switch_delay = np.empty(0, dtype=int)
+        self.switched = np.empty(0, dtype=int)
+
+    @property
+    def count(self):
+        """ The number of cars on the road. """
+        return len(self.uid)
+
+    def add_cars(self, lanes):
+        """
+        Adds new cars at the start of the road, the attributes are drawn in
+        the same way as in Car.__init__.
+
+        Args:
+            lanes (array): The start lane of each new car.
+        """
+        model = self.model
+        lanes = np.asarray(lanes, dtype=int)
+        n = len(lanes)
+        agression = np.full(n, model.agression)
+        max_speed = model.speed + np.abs(model.car_rng.standard_normal(n))*agression
+        delay = np.full(n, int(5 / model.agression / model.time_step))
+        new = {'uid': [model.next_id() for _ in range(n)],
+               'loc': np.zeros(n),
+               'lane': lanes,
+               'speed': max_speed,
+               'max_speed': max_speed,
+               'agression': agression,
+               'gap': model.car_rng.random(n) / agression + model.min_gap,
+               'switch_delay': delay,
+               'switched': delay}
+        for name in self.columns:
+            column = getattr(self, name)
+            setattr(self, name, np.concatenate((column, new[name]))
+                    .astype(column.dtype))
+
+    def _keep(self, mask):
+        """
+        Private method which only retains the cars selected by mask.
+        """
+        for name in self.columns:
+            setattr(self, name, getattr(self, name)[mask])
+
+    def get_free_lanes(self):
+        """
+        Determines for each lane if the first meters are empty, see
+        RoadSim.get_free_lanes.
+        """
+        zone = self.model.speed*self.model.time_step
+        occupied = np.bincount(self.lane[self.loc < zone],
+                               minlength=self.model.lanes)
+        return occupied == 0
+
+    def get_neighbors(self):
+        """
+        Batched version of LaneSpace.get_neighbors. Sorts the positions of
+        each lane once and looks up the closest cars of every car in the
+        lane and the two adjacent lanes.
+
+        Returns:
+            fronts ((n, 3) array): Positions of the cars in front on the
+                right, middle and left of each car.
+            backs ((n, 3) array): Positions of the cars behind on the
+                right, middle and left of each car.
+        """
+        fronts = np.full((self.count, 3), self.model.length*2.0)
+        backs = np.full((self.count, 3), -100.0)
+        for j in range(self.model.lanes):
+            row = np.sort(self.loc[self.lane == j])
+            if not len(row):
+                continue
+            near = (np.abs(self.lane - j) <= 1).nonzero()[0]
+            x = self.loc[near]
+            col = j - self.lane[near] + 1
+
+            front = np.searchsorted(row, x, side='right')
+            has = front < len(row)
+            fronts[near[has], col[has]] = row[front[has]]
+
+            back = np.searchsorted(row, x, side='left')
+            has = back > 0
+            backs[near[has], col[has]] = row[back[has]-1]
+        return fronts, backs
+
+    def compute_pars(self, cars, fronts, backs):
+        """
+        Batched version of Car.compute_pars for the selected cars.
+
+        Args:
+            cars (array): Indices of the cars to evaluate.
+            fronts ((n, 3) array): Positions of the cars in front.
+            backs ((n, 3) array): Positions of the cars behind.
+
+        Returns:
+            can_left, can_middle, can_right boolean arrays.
+        """
+        x = self.loc[cars]
+        space = self.gap[cars] * self.speed[cars]
+        lane = self.lane[cars]
+        recovered = self.switched[cars] == 0
+        rf, mf, lf = fronts[cars].T
+        rb, _, lb = backs[cars].T
+
+        can_left = (lf-x > space) & (x-lb > 0.5*space) &\
+            (lane < self.model.lanes-1) & recovered
+        can_right = (rf-x > space) & (x-rb > 0.5*space) &\
+            (lane > 0) & recovered
+        can_middle = mf-x > space
+        return can_left, can_middle, can_right
+
+    def _skip_stuck(self, cars, fronts, backs):
+        """
+        Private method which fast forwards the slowdown of cars for which
+        no move is possible. Such cars draw nothing but their deceleration
+        until their speed drops below the highest speed at which one of the
+        moves becomes possible, so all decelerations up to that point can
+        be drawn in blocks instead of one pass of get_moves at a time.
+
+        Args:
+            cars (array): Indices of cars without a possible move.
+            fronts ((n, 3) array): Positions of the cars in front.
+            backs ((n, 3) array): Positions of the cars behind.
+        """
+        time_step = self.model.time_step
+        x = self.loc[cars]
+        gap = self.gap[cars]
+        lane = self.lane[cars]
+        recovered = self.switched[cars] == 0
+        rf, mf, lf = fronts[cars].T
+        rb, _, lb = backs[cars].T
+
+        limit = (mf-x)/gap
+        left = np.minimum(lf-x, 2*(x-lb))/gap
+        right = np.minimum(rf-x, 2*(x-rb))/gap
+        limit = np.maximum(limit, np.where(
+            (lane < self.model.lanes-1) & recovered, left, -np.inf))
+        limit = np.maximum(limit, np.where(
+            (lane > 0) & recovered, right, -np.inf))
+
+        speed = self.speed[cars]
+        todo = (speed >= limit).nonzero()[0]
+        while len(todo):
+            block = np.cumsum(self.model.car_rng.random((len(todo), 32)), axis=1)
+            block = speed[todo, None] - block*time_step
+            passed = block < limit[todo, None]
+            done = passed.any(axis=1)
+            first = np.argmax(passed[done], axis=1)
+            speed[todo[done]] = block[done, first]
+            speed[todo[~done]] = block[~done, -1]
+            todo = todo[~done]
+        self.speed[cars] = speed
+
+    def get_moves(self, fronts, backs):
+        """
+        Batched version of Car.get_move. Cars for which no move is possible
+        slow down and are evaluated again, until every car has a move.
+
+        Args:
+            fronts ((n, 3) array): Positions of the cars in front.
+            backs ((n, 3) array): Positions of the cars behind.
+
+        Returns:
+            Integer array with the move of each car: -1 if right,
+            0 if forward, 1 if left.
+        """
+        time_step = self.model.time_step
+        self.switched = np.maximum(self.switched - 1, 0)
+        moves = np.zeros(self.count, dtype=int)
+        cars = np.arange(self.count)
+
+        while len(cars):
+            cl, cm, cr = self.compute_pars(cars, fronts, backs)
+            speed = self.speed[cars]
+            agression = self.agression[cars]
+            slowed = speed < self.max_speed[cars]
+            draws = self.model.car_rng.random((3, len(cars)))
+
+            # Forward at current speed, keep right or speed up
+            keep_right = cm & cr & (draws[0] > agression)
+            speed_up = cm & ~keep_right & slowed & (draws[1] < agression)
+            overtake = speed_up & cl
+
+            # Both sides free, overtake left, hold right or take most space
+            both = ~cm & cl & cr
+            pass_left = both & slowed & (draws[0] < agression)
+            hold_right = both & ~pass_left & (draws[1] > agression)
+            widest = both & ~pass_left & ~hold_right
+            rf, _, lf = fronts[cars].T
+
+            # Only one side free, otherwise slow down
+            left = ~cm & ~both & cl & (draws[0] < agression)
+            right = ~cm & ~both & ~cl & cr
+            stuck = ~cm & ~both & ~left & ~right
+
+            front_gap = fronts[cars, 1] - self.loc[cars]
+            diff = self.max_speed[cars] - speed
+            space = (front_gap-speed)/speed/self.gap[cars]/agression
+            speedup = np.fmax(draws[2], np.log(diff*space))
+
+            change = np.zeros(len(cars))
+            change[speed_up] = speedup[speed_up]
+            change[pass_left] = draws[1, pass_left]/agression[pass_left]
+            change[hold_right] = -draws[2, hold_right]/agression[hold_right]
+            change[right] = -draws[1, right]/agression[right]
+            change[stuck] = -draws[2, stuck]
+            self.speed[cars] = speed + change*time_step
+
+            switch = keep_right | pass_left | hold_right | left | right
+            self.switched[cars[switch]] = self.switch_delay[cars[switch]]
+
+            move = np.zeros(len(cars), dtype=int)
+            move[keep_right | hold_right | right] = -1
+            move[overtake | pass_left | left] = 1
+            move[widest] = np.where(rf[widest] > lf[widest], -1, 1)
+            moves[cars] = move
+
+            cars = cars[stuck]
+            self.model.slowdown_loops += len(cars)
+            blocked = ~cl[stuck]
+            self._skip_stuck(cars[blocked], fronts, backs)
+        return moves
+
+    def step(self):
+        """
+        Advances all cars by one time step. Equivalent to stepping each Car
+        agent: decide on a move, move or leave the road, and slow down cars
+        exceeding their maximum speed.
+        """
+        fronts, backs = self.get_neighbors()
+        with np.errstate(all='ignore'):
+            if self.kernel:
+                moves = kernels.get_moves(
+                    self.loc, self.lane, self.speed, self.max_speed,
+                    self.agression, self.gap, self.switch_delay,
+                    self.switched, fronts, backs, self.model.lanes,
+                    self.model.time_step, self.model.car_rng.generator)
+            else:
+                moves = self.get_moves(fronts, backs)
+        on_road = self.loc + self.speed <= self.model.length
+        self.loc = self.loc + self.speed*self.model.time_step
+        self.lane = self.lane + moves
+        if self.kernel:
+            kernels.clamp_speed(self.speed, self.max_speed,
+                                self.model.time_step,
+                                self.model.car_rng.generator)
+        else:
+            too_fast = self.speed > self.max_speed
+            self.speed[too_fast] -= self.model.car_rng.random(
+                np.count_nonzero(too_fast)) * self.model.time_step
+        self._keep(on_road)